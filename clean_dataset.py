@@ -2,14 +2,23 @@ import numpy as np
 import pandas as pd
 import pickle
 import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+import ok_engine
 
-def load_dataset():
+def load_dataset(path):
     """Loads the raw OkCupid dataset.
 
+    Args:
+        path (str): path of the raw OkCupid dataset.
+
     Returns:
         ok (pandas.DataFrame): original OkCupid dataset.
     """
-    ok = pd.read_csv("user_data_public.csv", low_memory=False)
+    ok = pd.read_csv(path, low_memory=False)
     return ok
 
 def initial_clean(ok):
@@ -124,56 +133,138 @@ def clean_gender(ok):
     ok['Other gender'] = np.where(~ok['d_gender'].isin(['Man', 'Woman']), 1, 0)
     return ok
 
-def create_binary_features(ok):
+def create_binary_features(ok, profile=None):
     """Creates new binary features.
     
     Binarises categorical features and cleans 'd_orientation' and 'd_gender'.
+    Each step is profiled as a stage of its own.
 
     Args:
         ok (pandas.DataFrame): OkCupid dataset.
+        profile (list): list of the records of the stages run so far, or None
+        if profiling is disabled.
 
     Returns:
         ok (pandas.DataFrame): OkCupid dataset with new binary features.
         new_features (list): a list of lists of newly created features sorted
         by group.
     """
-    ok, new_features = binarise_categoricals_str(ok)
-    ok = binarise_categoricals_yesno(ok)
-    ok = clean_orientation(ok)
-    ok = clean_gender(ok)
-    ok = ok.drop(columns=['d_education_phase','d_religion_type',
-                        'd_offspring_current','race',
-                        'd_drugs','d_smokes','d_drinks','d_orientation',
-                        'd_gender'])  # Drop columns we just processed
+    ok, new_features = run_stage(profile, 'binarise_categoricals_str',
+                                 binarise_categoricals_str, ok)
+    ok = run_stage(profile, 'binarise_categoricals_yesno',
+                   binarise_categoricals_yesno, ok)
+    ok = run_stage(profile, 'clean_orientation', clean_orientation, ok)
+    ok = run_stage(profile, 'clean_gender', clean_gender, ok)
+    ok = run_stage(profile, 'drop_processed_columns', ok.drop,
+                   columns=['d_education_phase','d_religion_type',
+                            'd_offspring_current','race',
+                            'd_drugs','d_smokes','d_drinks','d_orientation',
+                            'd_gender'])  # Drop columns we just processed
     return ok, new_features
 
-def clean_dataset():
+def peak_rss_mb():
+    """Measures the peak resident set size of the process so far.
+
+    Returns:
+        (float): peak resident set size in MB.
+    """
+    try:
+        import resource
+    except ImportError:  # Windows
+        import psutil
+        return psutil.Process().memory_info().peak_wset/2**20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak/2**20  # Bytes on macOS, KB elsewhere
+    return peak/2**10
+
+def run_stage(profile, name, function, *args, **kwargs):
+    """Runs a stage of the pipeline, profiling it if profiling is enabled.
+
+    Records the wall time of the stage, the peak resident set size of the
+    process after it, and the size of the dataset it returns, if any. As the
+    peak resident set size never decreases, it only shows the stages that
+    raise it. If memory is being traced with 'tracemalloc', the peak memory
+    allocated by the stage itself is also recorded; as tracing slows stages
+    that allocate many small objects, it is only started on request.
+
+    Args:
+        profile (list): list of the records of the stages run so far, or None
+        if profiling is disabled.
+        name (str): name of the stage.
+        function (function): the stage.
+        *args: arguments of the stage.
+        **kwargs: keyword arguments of the stage.
+
+    Returns:
+        result: what the stage returns.
+    """
+    if profile is None:
+        return function(*args, **kwargs)
+    traced = tracemalloc.is_tracing()
+    if traced:
+        tracemalloc.clear_traces()  # Also resets the peak
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    stage_peak_mb = None
+    if traced:
+        stage_peak_mb = tracemalloc.get_traced_memory()[1]/2**20
+    outputs = result if isinstance(result, tuple) else (result,)
+    frames = [x for x in outputs if isinstance(x, pd.DataFrame)]
+    frame_mb = None
+    if len(frames) > 0:
+        frame_mb = frames[0].memory_usage(deep=True).sum()/2**20
+    profile.append({'stage': name,
+                    'seconds': seconds,
+                    'peak_rss_mb': peak_rss_mb(),
+                    'stage_peak_mb': stage_peak_mb,
+                    'frame_mb': frame_mb})
+    print(f"{name}: {seconds:.3f} s, peak RSS {profile[-1]['peak_rss_mb']:.0f}"
+          " MB"
+          + ("" if stage_peak_mb is None
+             else f", stage peak {stage_peak_mb:.1f} MB")
+          + ("" if frame_mb is None else f", frame {frame_mb:.1f} MB"))
+    return result
+
+def clean_dataset(path, profile=None):
     """Loads and cleans the OkCupid dataset.
 
+    Args:
+        path (str): path of the raw OkCupid dataset.
+        profile (list): list of the records of the stages run so far, or None
+        if profiling is disabled.
+
     Returns:
         ok (pandas.DataFrame): cleaned OkCupid dataset.
         new_features (list): a list of lists of newly created features sorted
         by group.
     """
-    ok = load_dataset()
-    ok = initial_clean(ok)
-    ok, new_features = create_binary_features(ok)
+    ok = run_stage(profile, 'load_dataset', load_dataset, path)
+    ok = run_stage(profile, 'initial_clean', initial_clean, ok)
+    ok, new_features = create_binary_features(ok, profile)
     return ok, new_features
 
-def save_cleaned_dataset(ok):
+def save_cleaned_dataset(ok, directory):
     """Writes the cleaned OkCupid dataset to a .pkl file.
 
     Args:
         ok (pandas.DataFrame): cleaned OkCupid dataset.
+        directory (str): directory of the outputs.
     """
-    ok.to_pickle("ok.pkl")
+    ok.to_pickle(os.path.join(directory, "ok.pkl"))
 
-def save_new_features(new_features):
+def save_new_features(new_features, directory):
     """Adds additional groups to 'new_features'. Writes this to a .txt file.
 
     Args:
         new_features (list): list of lists of newly created features sorted
         by group.
+        directory (str): directory of the outputs.
+
+    Returns:
+        new_features (list): list of lists of newly created features sorted
+        by group, as written to 'new_features.txt'.
     """
     substances = ['Drugs often', 'Smokes', 'Drinks often']
     orientation = ['Straight', 'Gay', 'Bisexual', 'Other orientation']
@@ -181,28 +272,145 @@ def save_new_features(new_features):
     new_features = new_features + [substances] + [orientation] + [gender]
     for group in new_features:
         group.insert(0, '')
-    with open('new_features.txt', "wb") as f:
+    with open(os.path.join(directory, 'new_features.txt'), "wb") as f:
         pickle.dump(new_features, f)
+    return new_features
         
-def save_all_features(ok):
+def save_all_features(ok, directory):
     """Writes a list of all the features of the dataset to a .txt file.
 
     Args:
         ok (pandas.DataFrame): cleaned OkCupid dataset.
+        directory (str): directory of the outputs.
+
+    Returns:
+        features (list): list of all features.
     """
     ok_no_qs = ok[ok.columns.drop(list(ok.filter(regex='q')))]  # Remove qs
     features = ok_no_qs.columns.tolist()
-    with open('features.txt', 'w') as f:
+    with open(os.path.join(directory, 'features.txt'), 'w') as f:
         for line in features:
             f.write(f"{line}\n")
+    return features
+
+def save_manifest(ok, features, new_features, directory):
+    """Writes a manifest describing the layout of the cleaned outputs.
+    
+    The manifest records the column groups, dtypes, question IDs, row count,
+    content hash and size in memory of the cleaned dataset, and the IDs of the
+    traits and other continuous variables in the order of 'question_data.csv'
+    (the first 'ok_engine.NUM_TRAITS' are traits). It is checked by
+    'okapp.py' at startup, so that outputs from a different run or version of
+    this script are rejected rather than producing wrong filters. The size is
+    used by 'okapp.py' to keep the snapshots it holds within its memory
+    budget.
+
+    Args:
+        ok (pandas.DataFrame): cleaned OkCupid dataset, with its content hash
+        stored in 'ok.attrs'.
+        features (list): list of all features.
+        new_features (list): list of lists of newly created features sorted
+        by group, as written to 'new_features.txt'.
+        directory (str): directory of the outputs.
+    """
+    _, _, _, traits = ok_engine.read_qs_and_traits(features, directory)
+    trait_ids = list(ok_engine.traits_dictionary(traits).values())
+    manifest = {'version': ok_engine.MANIFEST_VERSION,
+                'row_count': len(ok),
+                'content_hash': ok.attrs['content_hash'],
+                'features': features,
+                'question_ids': [c for c in ok.columns
+                                 if ok_engine.is_question(c)],
+                'new_feature_groups': new_features,
+                'dtypes': ok.dtypes.astype(str).to_dict(),
+                'trait_ids': trait_ids[:ok_engine.NUM_TRAITS],
+                'other_continuous_ids': trait_ids[ok_engine.NUM_TRAITS:],
+                'memory_bytes': int(ok.memory_usage(deep=True).sum())}
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
             
-def main():
+def save_profile(profile, path):
+    """Writes the profile of the pipeline to a .json file.
+
+    Args:
+        profile (list): list of the records of each stage.
+        path (str): path of the report.
+    """
+    report = {'stages': profile,
+              'total_seconds': sum(stage['seconds'] for stage in profile),
+              'peak_rss_mb': max(stage['peak_rss_mb'] for stage in profile)}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+
+def compare_profile(profile, path, tolerance, min_seconds, min_mb):
+    """Compares the profile of the pipeline against a baseline report.
+
+    A metric of a stage regresses if it exceeds its baseline value by more
+    than the tolerance, and by more than an absolute floor, so that noise in
+    short or small stages is not reported. Stages and metrics missing from
+    either report are ignored.
+
+    Args:
+        profile (list): list of the records of each stage.
+        path (str): path of the baseline report.
+        tolerance (float): tolerated increase, as a fraction of the baseline.
+        min_seconds (float): smallest increase in wall time reported, in
+        seconds.
+        min_mb (float): smallest increase in memory reported, in MB.
+
+    Returns:
+        regressions (list): list of descriptions of each regression.
+    """
+    with open(path, 'r') as f:
+        baseline = {stage['stage']: stage for stage in json.load(f)['stages']}
+    floors = {'seconds': min_seconds,
+              'peak_rss_mb': min_mb,
+              'stage_peak_mb': min_mb,
+              'frame_mb': min_mb}
+    regressions = []
+    for stage in profile:
+        if stage['stage'] not in baseline:
+            continue
+        for metric, floor in floors.items():
+            before = baseline[stage['stage']].get(metric)
+            after = stage.get(metric)
+            if before is None or after is None:
+                continue
+            if after > before*(1 + tolerance) and after - before > floor:
+                regressions.append(f"{stage['stage']} {metric}: {before:.3f} "
+                                   f"-> {after:.3f} (+{after - before:.3f})")
+    return regressions
+
+def main(args):
     """Processes to be executed when 'clean_dataset.py' is called."""
-    ok, new_features = clean_dataset()
-    save_cleaned_dataset(ok)
-    save_new_features(new_features)
-    save_all_features(ok)
-    print('Dataset cleaned')
+    profile = [] if args.profile else None
+    if args.profile and args.trace_memory:
+        tracemalloc.start()
+    directory = ok_engine.snapshot_directory(args.snapshot)
+    os.makedirs(directory, exist_ok=True)
+    ok, new_features = clean_dataset(args.input, profile)
+    ok.attrs['content_hash'] = run_stage(profile, 'dataset_hash',
+                                         ok_engine.dataset_hash, ok)
+    run_stage(profile, 'save_cleaned_dataset', save_cleaned_dataset, ok,
+              directory)
+    new_features = run_stage(profile, 'save_new_features', save_new_features,
+                             new_features, directory)
+    features = run_stage(profile, 'save_all_features', save_all_features, ok,
+                         directory)
+    run_stage(profile, 'save_manifest', save_manifest, ok, features,
+              new_features, directory)
+    print(f'Dataset cleaned into "{directory}"')
+    if args.profile:
+        save_profile(profile, args.report)
+        print(f'Profile written to "{args.report}"')
+        if args.baseline is not None:
+            regressions = compare_profile(profile, args.baseline,
+                                          args.tolerance, args.min_seconds,
+                                          args.min_mb)
+            if len(regressions) > 0:
+                sys.exit("Regressions against baseline:\n"
+                         + "\n".join(regressions))
+            print('No regressions against baseline')
 
 
 if __name__ == "__main__":
@@ -216,11 +424,48 @@ carried out manually, but are automated when possible.
 Cleaned OkCupid dataset is written to "ok.pkl".
 List of all features is written to "features.txt".
 List of newly created features is written to "new_features.txt".
+Manifest of the layout of these outputs is written to "manifest.json".
+
+These are written to the working directory, or with "--snapshot NAME" to \
+"snapshots/NAME", so that several snapshots of the dataset (e.g. from \
+different crawls, or cleaned differently) may be held side by side and \
+switched between or compared in "okapp.py".
+
+With "--profile", the wall time, peak RSS and dataset size after each stage \
+are written to a .json report, and optionally compared against a baseline \
+report. With "--trace-memory" as well, the peak memory allocated by each \
+stage is traced and reported too, which slows the stages. The script fails if any \
+exceeds its baseline by more than the tolerance and by more than \
+"--min-seconds" or "--min-mb".
 
 Author: Harry Durnberger
 """
     parser = argparse.ArgumentParser(description=description,
                                      formatter_class=
                                      argparse.RawTextHelpFormatter)
+    parser.add_argument('--input', default='user_data_public.csv',
+                        help="path of the raw OkCupid dataset")
+    parser.add_argument('--snapshot', default='',
+                        help="name of the snapshot to write the outputs to, "
+                        "instead of the working directory")
+    parser.add_argument('--profile', action='store_true',
+                        help="profile each stage of the pipeline")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="with --profile, also trace the peak memory "
+                        "allocated by each stage, which slows the stages")
+    parser.add_argument('--report', default='profile.json',
+                        help="path of the profile report")
+    parser.add_argument('--baseline', default=None,
+                        help="path of a baseline profile report to compare "
+                        "against")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="tolerated increase over the baseline, as a "
+                        "fraction (default: 0.1)")
+    parser.add_argument('--min-seconds', type=float, default=0.25,
+                        help="smallest increase in wall time over the "
+                        "baseline reported (default: 0.25)")
+    parser.add_argument('--min-mb', type=float, default=5.0,
+                        help="smallest increase in memory over the baseline "
+                        "reported, in MB (default: 5)")
     args = parser.parse_args()
-    main()
\ No newline at end of file
+    main(args)
\ No newline at end of file
@@ -0,0 +1,201 @@
+import numpy as np
+import argparse
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+def post(url, path, body):
+    """Sends a POST request to the query API.
+
+    Args:
+        url (str): base URL of the API.
+        path (str): path of the endpoint.
+        body (dict): request body.
+
+    Returns:
+        status (int): HTTP status of the response.
+        response (dict): decoded response.
+    """
+    request = Request(url + path, data=json.dumps(body).encode(),
+                      headers={'Content-Type': 'application/json'})
+    try:
+        with urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except HTTPError as error:
+        return error.code, json.loads(error.read())
+
+def post_keep_alive(connection, path, body):
+    """Sends a POST request to the query API over a kept-alive connection.
+
+    Args:
+        connection (http.client.HTTPConnection): connection to the API.
+        path (str): path of the endpoint.
+        body (dict): request body.
+
+    Returns:
+        status (int): HTTP status of the response.
+        response (dict): decoded response.
+    """
+    connection.request('POST', path, body=json.dumps(body).encode(),
+                       headers={'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+def build_requests(url, num_requests, seed):
+    """Builds a random mix of requests resembling use of the app.
+
+    Each request asks for the distribution of answers to a random question,
+    among a demographic of one or two random categories and possibly a trait
+    percentile range, or compares two such demographics.
+
+    Args:
+        url (str): base URL of the API.
+        num_requests (int): number of requests.
+        seed (int): seed of the random number generator.
+
+    Returns:
+        requests (list): list of (path, body) tuples.
+    """
+    rng = random.Random(seed)
+    _, variables = post(url, '/variables', {})
+    _, found = post(url, '/questions', {})
+    q_ids = [q['id'] for q in found['questions']]
+    categories = [group for group in variables['categories'] if group]
+
+    def demographic():
+        chosen = rng.sample(categories, rng.randint(1, 2))
+        body = {'categories': [rng.choice(group) for group in chosen]}
+        if rng.random() < 0.5:
+            lower = rng.randrange(0, 100, 10)
+            body['traits'] = [{'trait': rng.choice(variables['traits']),
+                               'lower': lower,
+                               'upper': rng.randrange(lower + 10, 101, 10)}]
+        return body
+
+    requests = []
+    for _ in range(num_requests):
+        question = rng.choice(q_ids)
+        if rng.random() < 0.8:
+            requests.append(('/distribution', {'question': question,
+                                               'demographic': demographic()}))
+        else:
+            requests.append(('/compare', {'question': question,
+                                          'demographics': [demographic(),
+                                                           demographic()]}))
+    return requests
+
+def run(url, requests, concurrency, batch_size, keep_alive):
+    """Sends the requests concurrently and times each round trip.
+
+    With 'keep_alive', each client sends all of its requests over one
+    connection, held open until every client has finished, as a client
+    keeping a session would.
+
+    Args:
+        url (str): base URL of the API.
+        requests (list): list of (path, body) tuples.
+        concurrency (int): number of concurrent clients.
+        batch_size (int): number of requests sent in each '/batch' request,
+        or 1 to send requests individually.
+        keep_alive (bool): True to keep a connection open for each client,
+        False to open a connection for each request.
+
+    Returns:
+        latencies (numpy.ndarray): latency of each round trip in seconds.
+        errors (int): number of failed requests.
+        elapsed (float): total time taken in seconds.
+    """
+    if batch_size > 1:
+        requests = [('/batch', {'requests': [{'path': p, 'body': b}
+                                             for p, b in
+                                             requests[i:i + batch_size]]})
+                    for i in range(0, len(requests), batch_size)]
+
+    clients = threading.local()
+    connections = []
+
+    def send(request):
+        if not keep_alive:
+            return post(url, *request)
+        if not hasattr(clients, 'connection'):
+            clients.connection = HTTPConnection(urlparse(url).netloc)
+            connections.append(clients.connection)
+        return post_keep_alive(clients.connection, *request)
+
+    def timed(request):
+        start = time.perf_counter()
+        status, response = send(request)
+        latency = time.perf_counter() - start
+        if status != 200:
+            return latency, 1
+        if batch_size > 1:
+            return latency, sum('error' in r for r in response['results'])
+        return latency, 0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, requests))
+    elapsed = time.perf_counter() - start
+    for connection in connections:
+        connection.close()
+    latencies = np.array([latency for latency, _ in results])
+    errors = sum(e for _, e in results)
+    return latencies, errors, elapsed
+
+def report(latencies, errors, elapsed, num_requests):
+    """Prints the latency percentiles and throughput of the load test.
+
+    Args:
+        latencies (numpy.ndarray): latency of each round trip in seconds.
+        errors (int): number of failed requests.
+        elapsed (float): total time taken in seconds.
+        num_requests (int): number of requests.
+    """
+    p50, p99 = np.percentile(latencies, [50, 99])*1000
+    print(f"Round trips: {len(latencies)} ({num_requests} requests, "
+          f"{errors} errors)")
+    print(f"p50 latency: {p50:.1f} ms")
+    print(f"p99 latency: {p99:.1f} ms")
+    print(f"Throughput: {num_requests/elapsed:.1f} requests/s")
+
+def main(args):
+    """Processes to be executed when 'load_test.py' is called."""
+    requests = build_requests(args.url, args.requests, args.seed)
+    latencies, errors, elapsed = run(args.url, requests, args.concurrency,
+                                     args.batch_size, args.keep_alive)
+    report(latencies, errors, elapsed, len(requests))
+
+
+if __name__ == "__main__":
+    description = """This script load tests the query API served by \
+"ok_server.py", and reports the p50 and p99 latency of its responses.
+
+The server must already be running. With "--keep-alive", each client keeps \
+one connection open for all of its requests.
+
+Author: Harry Durnberger
+"""
+    parser = argparse.ArgumentParser(description=description,
+                                     formatter_class=
+                                     argparse.RawTextHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8765',
+                        help="base URL of the API")
+    parser.add_argument('--requests', type=int, default=1000,
+                        help="number of requests to send")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="number of concurrent clients")
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help="number of requests per '/batch' request, or 1 "
+                        "to send requests individually")
+    parser.add_argument('--keep-alive', action='store_true',
+                        help="keep one connection open per client")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed of the random mix of requests")
+    args = parser.parse_args()
+    main(args)
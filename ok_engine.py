@@ -0,0 +1,804 @@
+# Demographic filtering engine for the cleaned OkCupid dataset.
+#
+# Streamlit-free helpers used by "okapp.py". Demographic filters are resolved
+# to boolean row masks over the cleaned dataset so that any number of them may
+# be combined without copying the underlying dataframe.
+#
+# Several named snapshots of the cleaned dataset may be held, each with its own
+# indexes, in a cache with a memory budget shared by all of them.
+#
+# Author: Harry Durnberger
+
+import hashlib
+import json
+import os
+import pickle
+import re
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+import pandas as pd
+
+QUESTION_PATTERN = re.compile(r'^q\d+$')
+MANIFEST_VERSION = 2  # Bump whenever the layout of the cleaned outputs changes
+NUM_CATEGORICAL_GROUPS = 6  # Layout assumed by 'okapp.py'
+NUM_TRAITS = 50
+NUM_OTHER_CONTINUOUS = 3
+KEYWORDS = ['descriptive', 'preference', 'opinion', 'sex', 'intimacy',
+            'politics', 'religion', 'superstition', 'cognitive', 'technology',
+            'BDSM']
+SNAPSHOTS_DIRECTORY = 'snapshots'  # Of named outputs of 'clean_dataset.py'
+
+def read_dataset(directory='.'):
+    """Reads the cleaned dataset and list of features.
+
+    Args:
+        directory (str): directory of the outputs of 'clean_dataset.py'.
+
+    Returns:
+        ok (pandas.DataFrame): cleaned OkCupid dataset.
+        features (list): list of all features.
+    """
+    ok = pd.read_pickle(os.path.join(directory, "ok.pkl"))
+    with open(os.path.join(directory, 'features.txt'), 'r') as f:
+        lines = f.readlines()
+        features = []
+        for l in lines:
+            features.append(l.replace("\n",""))
+    return ok, features
+
+def read_qs_and_traits(features, directory='.'):
+    """Reads questions and traits information.
+    
+    Divides information into separate dataframes. The questions information is
+    the question, options and keywords associated with each question index. The
+    traits information is the name of each trait associated with each trait
+    index. A snapshot may have its own 'question_data.csv', otherwise the one
+    in the working directory is read.
+
+    Args:
+        features (list): list of all features.
+        directory (str): directory of the outputs of 'clean_dataset.py'.
+
+    Returns:
+        qs_and_traits (pandas.DataFrame): dataframe containing information
+        associated with all questions and traits.
+        qs (pandas.DataFrame): dataframe containing information associated with
+        all questions.
+        total_questions (int): original total number of questions.
+        traits (pandas.DataFrame): dataframe containing information associated
+        with all traits.
+    """
+    path = os.path.join(directory, "question_data.csv")
+    if not os.path.exists(path):
+        path = "question_data.csv"
+    qs_and_traits = pd.read_csv(path, sep=';')
+    qs = qs_and_traits[:-79]  # Keep only questions
+    qs.Keywords = qs.Keywords.fillna('Other')
+    total_questions = len(qs)
+    traits = qs_and_traits[qs_and_traits.iloc[:, 0].isin(features)]
+    return qs_and_traits, qs, total_questions, traits
+
+def read_new_features(directory='.'):
+    """Reads list of new features created in 'clean_dataset.py'.
+
+    Args:
+        directory (str): directory of the outputs of 'clean_dataset.py'.
+
+    Returns:
+        new_features (list): list of lists of newly created features sorted
+        by group.
+    """
+    with open(os.path.join(directory, "new_features.txt"), "rb") as f:
+        new_features = pickle.load(f)
+    return new_features
+
+def read_manifest(directory='.'):
+    """Reads the manifest written by 'clean_dataset.py'.
+
+    Args:
+        directory (str): directory of the outputs of 'clean_dataset.py'.
+
+    Returns:
+        manifest (dict): manifest of the cleaned outputs, or None if there is
+        no manifest.
+    """
+    path = os.path.join(directory, "manifest.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        manifest = json.load(f)
+    return manifest
+
+def read_trait_marginals(content_hash, directory='.'):
+    """Reads the trait marginals written by 'trait_marginals.py'.
+
+    The counts are memory-mapped rather than read, as only a few of them are
+    needed for any one demographic.
+
+    Args:
+        content_hash (str): content hash of the cleaned dataset.
+        directory (str): directory of the outputs of 'clean_dataset.py'.
+
+    Returns:
+        marginals (dict): trait marginals, or None if they have not been
+        computed for the cleaned dataset.
+    """
+    info = os.path.join(directory, "trait_marginals.pkl")
+    counts = os.path.join(directory, "trait_marginals.npy")
+    edge_counts = os.path.join(directory, "trait_marginals_edges.npy")
+    if not (os.path.exists(info) and os.path.exists(counts)
+            and os.path.exists(edge_counts)):
+        return None
+    with open(info, "rb") as f:
+        marginals = pickle.load(f)
+    if marginals['content_hash'] != content_hash:
+        return None
+    marginals['counts'] = np.load(counts, mmap_mode='r')
+    marginals['edge_counts'] = np.load(edge_counts, mmap_mode='r')
+    return marginals
+
+def read_related_questions(content_hash, directory='.'):
+    """Reads the related questions index written by 'question_associations.py'.
+
+    Args:
+        content_hash (str): content hash of the cleaned dataset.
+        directory (str): directory of the outputs of 'clean_dataset.py'.
+
+    Returns:
+        related (dict): list of (question ID, V, co-respondents) tuples for
+        each question ID, or an empty dictionary if the index has not been
+        computed for the cleaned dataset.
+    """
+    path = os.path.join(directory, "related_questions.pkl")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "rb") as f:
+        stored = pickle.load(f)
+    if stored['content_hash'] != content_hash:
+        return {}
+    return stored['related']
+
+def traits_dictionary(traits):
+    """Creates dictionary for traits and other continuous variables.
+    
+    The labels are the names of each trait or continuous variable. The values
+    are the indexes associated with each label.
+
+    Args:
+        traits (pandas.DataFrame): dataframe containing information associated
+        with all traits.
+
+    Returns:
+        traits (dict): traits dictionary.
+    """
+    traits = traits.set_index('text').to_dict()['Unnamed: 0']
+    return traits
+
+def filter_questions(qs, keywords):
+    """Filters the questions by keywords.
+
+    Args:
+        qs (pandas.DataFrame): dataframe containing information associated with
+        all questions.
+        keywords (list): list of keywords every question must have.
+
+    Returns:
+        qs (pandas.DataFrame): dataframe containing information associated with
+        filtered questions.
+    """
+    for keyword in keywords:
+        qs = qs[qs['Keywords'].str.contains(keyword)]
+    return qs
+
+def is_question(column):
+    """Checks whether a column of the cleaned dataset holds question answers.
+
+    Args:
+        column (str): name of the column.
+
+    Returns:
+        (bool): True if the column is a question ID, e.g. 'q2', False
+        otherwise.
+    """
+    return QUESTION_PATTERN.match(str(column)) is not None
+
+def build_answer_index(answers):
+    """Builds the answer-code index of a single question.
+
+    Each row is encoded as the position of its answer in the list of answers
+    to the question, or -1 if the individual did not answer the question.
+
+    Args:
+        answers (pandas.Series): answers given to the question, aligned with
+        the rows of the cleaned dataset.
+
+    Returns:
+        answer_index (tuple): the answer codes of each row (numpy.ndarray) and
+        the list of answers the codes refer to (list).
+    """
+    categorical = pd.Categorical(answers)
+    return categorical.codes, list(categorical.categories)
+
+def condition_mask(answer_index, answer):
+    """Resolves a single question-answer condition to a row mask.
+
+    Args:
+        answer_index (tuple): answer-code index of the question.
+        answer (str): answer the individuals must have given.
+
+    Returns:
+        mask (numpy.ndarray): boolean mask, True for each row whose
+        individual gave the answer.
+    """
+    codes, answers = answer_index
+    if answer not in answers:
+        return np.zeros(len(codes), dtype=bool)
+    return codes == answers.index(answer)
+
+def conditions_mask(answer_indexes, conditions, n_rows):
+    """Resolves any number of question-answer conditions to a row mask.
+
+    Args:
+        answer_indexes (dict): answer-code index of each conditioned question,
+        keyed by question ID.
+        conditions (list): list of (question ID, answer) tuples.
+        n_rows (int): number of rows of the cleaned dataset.
+
+    Returns:
+        mask (numpy.ndarray): boolean mask, True for each row whose
+        individual satisfies every condition.
+    """
+    mask = np.ones(n_rows, dtype=bool)
+    for q_number, answer in conditions:
+        mask &= condition_mask(answer_indexes[q_number], answer)
+    return mask
+
+def mask_rows(mask, index, rows):
+    """Restricts a row mask over the cleaned dataset to a subset of its rows.
+
+    Args:
+        mask (numpy.ndarray): boolean mask over the rows of the cleaned
+        dataset.
+        index (pandas.Index): index of the cleaned dataset.
+        rows (pandas.Index): index labels of the subset of rows.
+
+    Returns:
+        (numpy.ndarray): boolean mask aligned with 'rows'.
+    """
+    return mask[index.get_indexer(rows)]
+
+def rows_mask(index, rows):
+    """Converts a subset of rows of the cleaned dataset to a row mask.
+
+    Args:
+        index (pandas.Index): index of the cleaned dataset.
+        rows (pandas.Index): index labels of the subset of rows.
+
+    Returns:
+        mask (numpy.ndarray): boolean mask over the rows of the cleaned
+        dataset, True for each row in the subset.
+    """
+    mask = np.zeros(len(index), dtype=bool)
+    mask[index.get_indexer(rows)] = True
+    return mask
+
+def build_trait_block(ok, trait_ids):
+    """Extracts the continuous traits of the cleaned dataset as one block.
+
+    Args:
+        ok (pandas.DataFrame): cleaned OkCupid dataset.
+        trait_ids (list): list of IDs of the traits.
+
+    Returns:
+        block (numpy.ndarray): float32 matrix with a row for each individual
+        and a column for each trait.
+    """
+    return ok[trait_ids].to_numpy(dtype=np.float32)
+
+def summarise_traits(block):
+    """Computes the column-wise mean, median and standard deviation of traits.
+
+    Args:
+        block (numpy.ndarray): float32 trait block, or a subset of its rows.
+
+    Returns:
+        summary (numpy.ndarray): matrix with rows mean, median and standard
+        deviation, and a column for each trait.
+    """
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.stack([np.nanmean(block, axis=0),
+                         np.nanmedian(block, axis=0),
+                         np.nanstd(block, axis=0)])
+
+def trait_profile(block, mask, population, trait_names):
+    """Compares the trait profile of a demographic with the population's.
+
+    The effect size of each trait is the difference between the demographic
+    and population means, in units of the population standard deviation.
+
+    Args:
+        block (numpy.ndarray): float32 trait block.
+        mask (numpy.ndarray): boolean mask over the rows of the block, True
+        for each individual in the demographic.
+        population (numpy.ndarray): summary of the whole block, as returned by
+        'summarise_traits'.
+        trait_names (list): list of names of the traits, in column order.
+
+    Returns:
+        profile (pandas.DataFrame): mean, median and effect size of each trait
+        for the demographic, alongside the population mean and median.
+    """
+    demographic = summarise_traits(block[mask])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        effect = (demographic[0] - population[0])/population[2]
+    return pd.DataFrame({'Mean': demographic[0],
+                         'Population mean': population[0],
+                         'Median': demographic[1],
+                         'Population median': population[1],
+                         'Effect size': effect}, index=trait_names)
+
+def dataset_hash(ok):
+    """Computes a hash of the contents of the cleaned dataset.
+
+    Columns are hashed one at a time to keep memory use low.
+
+    Args:
+        ok (pandas.DataFrame): cleaned OkCupid dataset.
+
+    Returns:
+        (str): hexadecimal SHA-256 digest of the column names, dtypes and
+        values.
+    """
+    digest = hashlib.sha256()
+    digest.update(pd.util.hash_pandas_object(ok.index).to_numpy().tobytes())
+    for column in ok.columns:
+        digest.update(f"{column}:{ok[column].dtype};".encode())
+        values = pd.util.hash_pandas_object(ok[column], index=False)
+        digest.update(values.to_numpy().tobytes())
+    return digest.hexdigest()
+
+def validate_manifest(manifest, ok, features, new_features, qs, traits):
+    """Checks the loaded outputs of 'clean_dataset.py' against its manifest.
+
+    Apart from comparing lists of names, every check is constant time. The
+    contents of the dataset are checked by comparing the hash stored with it
+    to the hash in the manifest, rather than by rehashing it.
+
+    Args:
+        manifest (dict): manifest written by 'clean_dataset.py'.
+        ok (pandas.DataFrame): cleaned OkCupid dataset.
+        features (list): list of all features.
+        new_features (list): list of lists of newly created features sorted
+        by group.
+        qs (pandas.DataFrame): dataframe containing information associated with
+        all questions.
+        traits (dict): traits dictionary.
+
+    Returns:
+        errors (list): list of descriptions of each mismatch, empty if the
+        outputs match the manifest.
+    """
+    if manifest.get('version') != MANIFEST_VERSION:
+        return [f"manifest version {manifest.get('version')} is not "
+                f"{MANIFEST_VERSION}, please rerun 'clean_dataset.py'"]
+    errors = []
+    if len(ok) != manifest['row_count']:
+        errors.append(f"dataset has {len(ok)} rows, manifest has "
+                      f"{manifest['row_count']}")
+    if ok.attrs.get('content_hash') != manifest['content_hash']:
+        errors.append("dataset contents do not match the manifest")
+    if features != manifest['features']:
+        errors.append("list of features does not match the manifest")
+    if len(ok.columns) != (len(manifest['features'])
+                           + len(manifest['question_ids'])):
+        errors.append(f"dataset has {len(ok.columns)} columns, manifest has "
+                      f"{len(manifest['features'])} features and "
+                      f"{len(manifest['question_ids'])} questions")
+    if new_features != manifest['new_feature_groups']:
+        errors.append("new features do not match the manifest")
+    if len(new_features) != NUM_CATEGORICAL_GROUPS:
+        errors.append(f"expected {NUM_CATEGORICAL_GROUPS} groups of new "
+                      f"features, found {len(new_features)}")
+    if set(qs['Unnamed: 0']) != set(manifest['question_ids']):
+        errors.append("questions in 'question_data.csv' do not match the "
+                      "questions of the dataset")
+    if len(traits) != NUM_TRAITS + NUM_OTHER_CONTINUOUS:
+        errors.append(f"expected {NUM_TRAITS + NUM_OTHER_CONTINUOUS} traits "
+                      f"and other continuous variables, found {len(traits)}")
+    trait_ids = list(traits.values())
+    if trait_ids[:NUM_TRAITS] != manifest['trait_ids']:
+        errors.append(f"the first {NUM_TRAITS} variables in "
+                      "'question_data.csv' are not the traits of the "
+                      "manifest, in order")
+    if trait_ids[NUM_TRAITS:] != manifest['other_continuous_ids']:
+        errors.append("the other continuous variables in 'question_data.csv' "
+                      "are not those of the manifest, in order")
+    dtypes = manifest['dtypes']
+    not_numeric = [t for t in traits.values()
+                   if not dtypes.get(t, '').startswith(('float', 'int'))]
+    if len(not_numeric) > 0:
+        errors.append(f"traits are not numeric: {', '.join(not_numeric)}")
+    return errors
+
+def filter_categoricals(ok1, chosen_all):
+    """Filters OkCupid dataset by selected categorical variables.
+
+    Args:
+        ok1 (pandas.DataFrame): OkCupid dataset.
+        chosen_all (list): list of all chosen categoricals.
+
+    Returns:
+        ok1 (pandas.DataFrame): filtered OkCupid dataset.
+    """
+    mask = np.ones(len(ok1), dtype=bool)
+    for category in chosen_all:
+        mask &= (ok1[category] == 1).to_numpy()
+    return ok1[mask]
+
+def filter_traits(ok1, selected_range, chosen_trait_ids):
+    """Filters the OkCupid dataset by selected continuous variables.
+    
+    Filters each trait by the corresponding selected percentile range. The
+    lower and upper percentile bounds of each continuous variable are scaled to
+    the range of values in 'ok1'.
+
+    Args:
+        ok1 (pandas.DataFrame): OkCupid dataset.
+        selected_range (numpy.ndarray): matrix of chosen percentile range
+        boundary values.
+        chosen_trait_ids (list): list of IDs corresponding to chosen traits.
+
+    Returns:
+        ok1 (pandas.DataFrame): filtered OkCupid dataset.
+    """
+    for i, trait in enumerate(chosen_trait_ids):
+        total_range = ok1[trait].max() - ok1[trait].min()
+        lowerbound = percentile_bound(selected_range[i, 0], ok1[trait].min(),
+                                      total_range)
+        upperbound = percentile_bound(selected_range[i, 1], ok1[trait].min(),
+                                      total_range)
+        ok1 = ok1[(ok1[trait] >= lowerbound) & (ok1[trait] <= upperbound)]
+    return ok1
+
+def percentile_bound(percentile, minimum, total_range):
+    """Scales a percentile range boundary to the range of values of a trait.
+
+    Shared by 'filter_traits' and 'trait_marginals.py', so that precomputed
+    bucket edges are bit-for-bit equal to the bounds used to filter rows.
+
+    Args:
+        percentile (float or numpy.ndarray): percentile range boundary value.
+        minimum (float or numpy.ndarray): minimum value of the trait.
+        total_range (float or numpy.ndarray): range of values of the trait.
+
+    Returns:
+        (float or numpy.ndarray): boundary value of the trait.
+    """
+    return percentile*0.01*total_range + minimum
+
+def filter_demographic(ok, ok1, demographic, answer_indexes):
+    """Filters the OkCupid dataset by every selection defining a demographic.
+
+    The question-answer conditions are applied first, then the categorical
+    variables, then the continuous variables, whose percentile ranges are
+    scaled to the values remaining after the preceding filters.
+
+    Args:
+        ok (pandas.DataFrame): cleaned OkCupid dataset.
+        ok1 (pandas.DataFrame): OkCupid dataset.
+        demographic (dict): selections defining the demographic, with keys
+        'conditions' (list of (question ID, answer) tuples), 'categories'
+        (list of chosen categoricals), 'have_kids' and 'no_kids' (bool),
+        'selected_range' (numpy.ndarray of percentile range boundary values)
+        and 'trait_ids' (list of IDs of chosen traits).
+        answer_indexes (dict): answer-code index of each conditioned question,
+        keyed by question ID.
+
+    Returns:
+        ok1 (pandas.DataFrame): filtered OkCupid dataset.
+    """
+    conditions = demographic['conditions']
+    if len(conditions) > 0:
+        mask = conditions_mask(answer_indexes, conditions, len(ok))
+        ok1 = ok1[mask_rows(mask, ok.index, ok1.index)]
+    if len(demographic['categories']) > 0:
+        ok1 = filter_categoricals(ok1, demographic['categories'])
+    if demographic['have_kids']:
+        ok1 = ok1[ok1['Has kids'] == 1]
+    if demographic['no_kids']:
+        ok1 = ok1[ok1['Has kids'] == 0]
+    if len(demographic['trait_ids']) > 0:
+        ok1 = filter_traits(ok1, demographic['selected_range'],
+                            demographic['trait_ids'])
+    return ok1
+
+def marginal_counts(marginals, q_number, removed, demographic):
+    """Looks up the answer counts of a demographic in the trait marginals.
+
+    Answers demographics defined by a single trait percentile range aligned
+    with the buckets of the marginals, optionally combined with one
+    categorical variable, by summing precomputed counts. Any other
+    demographic must be filtered row by row.
+
+    Args:
+        marginals (dict): trait marginals written by 'trait_marginals.py'.
+        q_number (str): ID of chosen question.
+        removed (list): list of options removed from the chosen question.
+        demographic (dict): selections defining the demographic.
+
+    Returns:
+        counts (pandas.Series): number of individuals in the demographic
+        choosing each option, in descending order, or None if the demographic
+        cannot be answered from the marginals.
+    """
+    if (len(removed) > 0 or len(demographic['conditions']) > 0
+            or len(demographic['categories']) > 1 or demographic['have_kids']
+            or demographic['no_kids'] or len(demographic['trait_ids']) != 1):
+        return None
+    q = marginals['question_positions'].get(q_number)
+    c = marginals['category_positions'].get(
+        demographic['categories'][0] if demographic['categories'] else '')
+    t = marginals['trait_positions'].get(demographic['trait_ids'][0])
+    if q is None or c is None or t is None:
+        return None
+    step = 100/marginals['buckets']
+    lower, upper = demographic['selected_range'][0]/step
+    if lower != int(lower) or upper != int(upper) or lower >= upper:
+        return None  # Not aligned with the buckets
+    lower, upper = int(lower), int(upper)
+    answers = marginals['answers'][q]
+    counts = marginals['counts'][q, c, t, lower:upper].sum(axis=0)
+    if lower > 0:  # Individuals on the lower bound are in the bucket below
+        counts = counts + marginals['edge_counts'][q, c, t, lower - 1]
+    counts = pd.Series(counts[:len(answers)], index=answers, name=q_number)
+    return counts[counts > 0].sort_values(ascending=False, kind='stable')
+
+def snapshot_counts(snapshot, q_number, removed, demographic):
+    """Counts the answers of the population and a demographic of a snapshot.
+
+    Used to compare the same demographic across snapshots, so the demographic
+    is looked up in the trait marginals of the snapshot if possible, and
+    otherwise filtered from its dataset.
+
+    Args:
+        snapshot (dict): dataset snapshot, as loaded by 'load_snapshot'.
+        q_number (str): ID of chosen question.
+        removed (list): list of options removed from the chosen question.
+        demographic (dict): selections defining the demographic, or None.
+
+    Returns:
+        population (pandas.Series): number of individuals in the population
+        choosing each option, in descending order, or None if the snapshot
+        does not have the question.
+        counts (pandas.Series): the same for the demographic, or None.
+    """
+    ok = snapshot['ok']
+    if q_number not in ok.columns:
+        return None, None
+    ok1 = ok[snapshot['features'] + [q_number]].dropna(subset=[q_number])
+    for option in removed:
+        ok1 = ok1[ok1[q_number] != option]
+    population = ok1[q_number].value_counts()
+    if demographic is None:
+        return population, None
+    counts = None
+    if snapshot['marginals'] is not None:
+        counts = marginal_counts(snapshot['marginals'], q_number, removed,
+                                 demographic)
+    if counts is None:
+        answer_indexes = {q: snapshot_answer_index(snapshot, q)
+                          for q, _ in demographic['conditions']}
+        ok1 = filter_demographic(ok, ok1, demographic, answer_indexes)
+        counts = ok1[q_number].value_counts()
+    return population, counts
+
+def snapshot_directory(name):
+    """Finds the directory of the outputs of a dataset snapshot.
+
+    Args:
+        name (str): name of the snapshot, or '' for the outputs in the working
+        directory.
+
+    Returns:
+        (str): directory of the outputs of 'clean_dataset.py'.
+    """
+    if name == '':
+        return '.'
+    return os.path.join(SNAPSHOTS_DIRECTORY, name)
+
+def list_snapshots():
+    """Lists the dataset snapshots written by 'clean_dataset.py'.
+
+    Returns:
+        names (list): names of the snapshots, in alphabetical order after ''
+        for the outputs in the working directory if there are any.
+    """
+    names = [''] if os.path.exists("ok.pkl") else []
+    if os.path.isdir(SNAPSHOTS_DIRECTORY):
+        for name in sorted(os.listdir(SNAPSHOTS_DIRECTORY)):
+            directory = snapshot_directory(name)
+            if os.path.exists(os.path.join(directory, "ok.pkl")):
+                names.append(name)
+    return names
+
+def load_snapshot(name):
+    """Loads a dataset snapshot and checks it against its manifest.
+
+    The related questions and trait marginals are only loaded if the snapshot
+    matches its manifest.
+
+    Args:
+        name (str): name of the snapshot.
+
+    Returns:
+        snapshot (dict): the cleaned dataset and associated information, the
+        mismatches with its manifest, its approximate size in memory, and
+        caches of the indexes built from it.
+    """
+    directory = snapshot_directory(name)
+    ok, features = read_dataset(directory)
+    qs_and_traits, qs, total_questions, traits = read_qs_and_traits(features,
+                                                                    directory)
+    new_features = read_new_features(directory)
+    manifest = read_manifest(directory)
+    traits = traits_dictionary(traits)
+    if manifest is None:
+        errors = ["'manifest.json' not found"]
+    else:
+        errors = validate_manifest(manifest, ok, features, new_features, qs,
+                                   traits)
+    related = {}
+    marginals = None
+    if len(errors) == 0:
+        related = read_related_questions(manifest['content_hash'], directory)
+        marginals = read_trait_marginals(manifest['content_hash'], directory)
+    nbytes = None if manifest is None else manifest.get('memory_bytes')
+    if nbytes is None:
+        nbytes = int(ok.memory_usage(deep=True).sum())
+    return {'name': name,
+            'ok': ok,
+            'features': features,
+            'qs_and_traits': qs_and_traits,
+            'qs': qs,
+            'total_questions': total_questions,
+            'traits': traits,
+            'new_features': new_features,
+            'manifest': manifest,
+            'errors': errors,
+            'related': related,
+            'marginals': marginals,
+            'nbytes': nbytes,
+            'lock': threading.Lock(),
+            'answer_indexes': {},
+            'trait_block': None}
+
+def snapshot_answer_index(snapshot, q_number):
+    """Gets the answer-code index of a question of a snapshot, building it if
+    needed.
+
+    Args:
+        snapshot (dict): dataset snapshot, as loaded by 'load_snapshot'.
+        q_number (str): ID of the question.
+
+    Returns:
+        answer_index (tuple): answer-code index of the question.
+    """
+    with snapshot['lock']:
+        if q_number in snapshot['answer_indexes']:
+            return snapshot['answer_indexes'][q_number]
+    index = build_answer_index(snapshot['ok'][q_number])
+    with snapshot['lock']:
+        if q_number not in snapshot['answer_indexes']:
+            snapshot['answer_indexes'][q_number] = index
+            snapshot['nbytes'] += index[0].nbytes
+        return snapshot['answer_indexes'][q_number]
+
+def snapshot_trait_block(snapshot):
+    """Gets the block of continuous traits of a snapshot and the summary of
+    its population, building them if needed.
+
+    Args:
+        snapshot (dict): dataset snapshot, as loaded by 'load_snapshot'.
+
+    Returns:
+        block (numpy.ndarray): float32 matrix with a row for each individual
+        and a column for each trait.
+        population (numpy.ndarray): mean, median and standard deviation of
+        each trait over the population.
+    """
+    with snapshot['lock']:
+        if snapshot['trait_block'] is None:
+            block = build_trait_block(snapshot['ok'],
+                                      list(snapshot['traits'].values()))
+            snapshot['trait_block'] = (block, summarise_traits(block))
+            snapshot['nbytes'] += block.nbytes
+        return snapshot['trait_block']
+
+def snapshot_cache(budget_bytes):
+    """Creates an empty cache of loaded snapshots.
+
+    Args:
+        budget_bytes (int): memory budget shared by all the snapshots held.
+
+    Returns:
+        cache (dict): budget, snapshots held in order of use, futures and
+        reserved size of the snapshots being loaded, and lock of the cache.
+    """
+    return {'budget': budget_bytes,
+            'snapshots': OrderedDict(),
+            'loading': {},
+            'reserved': 0,
+            'lock': threading.Lock()}
+
+def evict_snapshots(cache, keep):
+    """Evicts the least recently used snapshots until the cache fits its
+    budget, along with the snapshots being loaded.
+
+    Must be called with the lock of the cache held. An evicted snapshot, with
+    its indexes, is freed once nothing else refers to it.
+
+    Args:
+        cache (dict): cache of loaded snapshots.
+        keep (int): number of most recently used snapshots never evicted.
+    """
+    snapshots = cache['snapshots']
+    while (len(snapshots) > keep
+           and sum(s['nbytes'] for s in snapshots.values()) + cache['reserved']
+           > cache['budget']):
+        snapshots.popitem(last=False)
+
+def get_snapshot(cache, name):
+    """Gets a snapshot from the cache, loading it if needed.
+
+    The lock of the cache is only held to look up, add and evict snapshots,
+    so snapshots held are returned while others are being loaded. Each
+    snapshot is loaded by the first caller to request it, and later callers
+    wait for that load. Before a snapshot is loaded, room is reserved for the
+    size recorded in its manifest. The snapshot requested is always held,
+    even if it alone exceeds the budget.
+
+    Args:
+        cache (dict): cache of loaded snapshots.
+        name (str): name of the snapshot.
+
+    Returns:
+        snapshot (dict): dataset snapshot, as loaded by 'load_snapshot'.
+    """
+    with cache['lock']:
+        snapshots = cache['snapshots']
+        if name in snapshots:
+            snapshots.move_to_end(name)
+            evict_snapshots(cache, 1)  # Its indexes may have grown
+            return snapshots[name]
+        loading = cache['loading'].get(name)
+        if loading is None:
+            loading = cache['loading'][name] = Future()
+            manifest = read_manifest(snapshot_directory(name))
+            expected = (0 if manifest is None
+                        else manifest.get('memory_bytes', 0))
+            cache['reserved'] += expected
+            evict_snapshots(cache, 0)
+        else:
+            expected = None  # Loaded by another caller
+    if expected is None:
+        return loading.result()
+    try:
+        snapshot = load_snapshot(name)
+    except BaseException as error:
+        with cache['lock']:
+            cache['reserved'] -= expected
+            del cache['loading'][name]
+        loading.set_exception(error)
+        raise
+    with cache['lock']:
+        cache['reserved'] -= expected
+        del cache['loading'][name]
+        snapshots[name] = snapshot
+        evict_snapshots(cache, 1)
+    loading.set_result(snapshot)
+    return snapshot
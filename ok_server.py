@@ -0,0 +1,424 @@
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import ok_engine
+
+_state = None  # Loaded dataset, set by 'load_state'
+
+class RequestError(Exception):
+    """Raised when a request is invalid. Answered with status 400."""
+
+def load_state(name):
+    """Loads a snapshot of the cleaned dataset once and checks it against its
+    manifest.
+
+    Args:
+        name (str): name of the snapshot, or '' for the outputs in the working
+        directory.
+
+    Returns:
+        state (dict): the snapshot, as loaded by 'ok_engine.load_snapshot',
+        with a cache of the per-question datasets.
+    """
+    state = ok_engine.load_snapshot(name)
+    if len(state['errors']) > 0:
+        sys.exit("The cleaned dataset does not match its manifest, please "
+                 "rerun 'clean_dataset.py':\n" + "\n".join(state['errors']))
+    state['answered'] = OrderedDict()
+    return state
+
+def answered_question(q_number, max_cached=16):
+    """Gets the dataset of the individuals that answered a question.
+
+    The most recently used datasets are cached, as in 'okapp.py' this is the
+    dataset every demographic of the question is filtered from.
+
+    Args:
+        q_number (str): ID of the question.
+        max_cached (int): number of datasets to keep cached.
+
+    Returns:
+        ok1 (pandas.DataFrame): features and answers of the individuals that
+        answered the question.
+    """
+    if not ok_engine.is_question(q_number) or q_number not in _state['ok']:
+        raise RequestError(f"unknown question '{q_number}'")
+    answered = _state['answered']
+    with _state['lock']:
+        if q_number in answered:
+            answered.move_to_end(q_number)
+            return answered[q_number]
+    columns = _state['features'] + [q_number]
+    ok1 = _state['ok'][columns].dropna(subset=[q_number])
+    with _state['lock']:
+        answered[q_number] = ok1
+        while len(answered) > max_cached:
+            answered.popitem(last=False)
+    return ok1
+
+def parse_demographic(body):
+    """Converts a demographic given in a request to the form used by okapp.
+
+    A demographic is given as an object with optional keys 'conditions' (list
+    of [question ID, answer] pairs), 'categories' (list of categorical
+    variables), 'have_kids' and 'no_kids' (booleans) and 'traits' (list of
+    objects with keys 'trait', a name or ID, and 'lower' and 'upper',
+    percentiles).
+
+    Args:
+        body (dict): demographic given in the request.
+
+    Returns:
+        demographic (dict): selections defining the demographic, as expected
+        by 'ok_engine.filter_demographic'.
+    """
+    if not isinstance(body, dict):
+        raise RequestError("demographic must be an object")
+    conditions = [tuple(condition) for condition in body.get('conditions', [])]
+    for q_number, _ in conditions:
+        if q_number not in _state['ok'] or not ok_engine.is_question(q_number):
+            raise RequestError(f"unknown question '{q_number}'")
+    categories = body.get('categories', [])
+    known = [c for group in _state['new_features'] for c in group if c != '']
+    for category in categories:
+        if category not in known:
+            raise RequestError(f"unknown category '{category}'")
+    trait_ids = []
+    selected_range = np.zeros(shape=(len(body.get('traits', [])), 2))
+    ids = set(_state['traits'].values())
+    for t, trait in enumerate(body.get('traits', [])):
+        if not isinstance(trait, dict):
+            raise RequestError("each trait must be an object")
+        name = trait.get('trait')
+        trait_id = _state['traits'].get(name, name)
+        if trait_id not in ids:
+            raise RequestError(f"unknown trait '{name}'")
+        trait_ids.append(trait_id)
+        selected_range[t, 0] = trait.get('lower', 0)
+        selected_range[t, 1] = trait.get('upper', 100)
+    return {'conditions': conditions,
+            'categories': categories,
+            'have_kids': bool(body.get('have_kids', False)),
+            'no_kids': bool(body.get('no_kids', False)),
+            'selected_range': selected_range,
+            'trait_ids': trait_ids}
+
+def select(body):
+    """Filters the individuals that answered a question by a demographic.
+
+    Args:
+        body (dict): request with keys 'question', and optionally 'remove'
+        (list of options to remove, as in 'okapp.py') and 'demographic'.
+
+    Returns:
+        ok1 (pandas.DataFrame): dataset of the demographic.
+        q_number (str): ID of the question.
+    """
+    q_number = body.get('question')
+    ok1 = answered_question(q_number)
+    remove = body.get('remove', [])
+    if len(remove) > 0:
+        ok1 = ok1[~ok1[q_number].isin(remove)]
+    if 'demographic' in body:
+        demographic = parse_demographic(body['demographic'])
+        answer_indexes = {q: ok_engine.snapshot_answer_index(_state, q)
+                          for q, _ in demographic['conditions']}
+        ok1 = ok_engine.filter_demographic(_state['ok'], ok1, demographic,
+                                           answer_indexes)
+    return ok1, q_number
+
+def answer_counts(body):
+    """Counts the answers of a demographic to a question.
+
+    Demographics that can be answered from the trait marginals are, without
+    filtering the dataset.
+
+    Args:
+        body (dict): request, as for 'select'.
+
+    Returns:
+        counts (pandas.Series): number of individuals in the demographic
+        choosing each option, in descending order.
+    """
+    if _state['marginals'] is not None and 'demographic' in body:
+        counts = ok_engine.marginal_counts(_state['marginals'],
+                                           body.get('question'),
+                                           body.get('remove', []),
+                                           parse_demographic(
+                                               body['demographic']))
+        if counts is not None:
+            return counts
+    ok1, q_number = select(body)
+    return ok1[q_number].value_counts()
+
+def describe(counts):
+    """Describes the distribution of the answers of a demographic.
+
+    Args:
+        counts (pandas.Series): number of individuals in the demographic
+        choosing each option, in descending order.
+
+    Returns:
+        (dict): number of individuals, and count and probability of each
+        answer, in descending order.
+    """
+    total = int(np.sum(counts))
+    return {'count': total,
+            'counts': {answer: int(n) for answer, n in counts.items()},
+            'probabilities': {answer: n/total for answer, n in counts.items()}}
+
+def questions(body):
+    """Searches the questions.
+
+    Args:
+        body (dict): request with optional keys 'keywords' (list of keywords
+        every question must have) and 'text' (text every question must
+        contain, ignoring case).
+
+    Returns:
+        (dict): ID, text and options of each matching question.
+    """
+    qs = ok_engine.filter_questions(_state['qs'], body.get('keywords', []))
+    text = body.get('text', '')
+    if text != '':
+        qs = qs[qs['text'].str.contains(text, case=False, regex=False)]
+    return {'questions': [{'id': row['Unnamed: 0'],
+                           'text': row['text'],
+                           'options': [row[f'option_{i}'] for i in range(1, 5)
+                                       if pd.isna(row[f'option_{i}']) == False]}
+                          for _, row in qs.iterrows()]}
+
+def variables(body):
+    """Lists the categorical and continuous variables demographics may use.
+
+    Args:
+        body (dict): request (unused).
+
+    Returns:
+        (dict): groups of categorical variables and names of traits.
+    """
+    return {'categories': [[c for c in group if c != '']
+                           for group in _state['new_features']],
+            'traits': list(_state['traits'].keys())}
+
+def count_demographic(body):
+    """Counts the individuals of a demographic that answered a question.
+
+    Args:
+        body (dict): request, as for 'select'.
+
+    Returns:
+        (dict): number of individuals in the demographic.
+    """
+    return {'count': int(np.sum(answer_counts(body)))}
+
+def distribution(body):
+    """Computes the distribution of the answers of a demographic.
+
+    Args:
+        body (dict): request, as for 'select'.
+
+    Returns:
+        (dict): distribution, as returned by 'describe'.
+    """
+    return describe(answer_counts(body))
+
+def compare(body):
+    """Compares the distributions of answers of demographics to a question.
+
+    Args:
+        body (dict): request with keys 'question', 'demographics' (list of
+        demographics) and optionally 'remove'.
+
+    Returns:
+        (dict): distribution of the population and of each demographic.
+    """
+    population = {k: v for k, v in body.items() if k != 'demographics'}
+    results = {'population': describe(answer_counts(population)),
+               'demographics': []}
+    for demographic in body.get('demographics', []):
+        counts = answer_counts(dict(population, demographic=demographic))
+        results['demographics'].append(describe(counts))
+    return results
+
+def batch(body):
+    """Answers a batch of requests in one round trip.
+
+    Requests are answered in order. Those about the same question share its
+    cached dataset. A failed request does not fail the batch.
+
+    Args:
+        body (dict): request with key 'requests', a list of objects with keys
+        'path' and 'body'.
+
+    Returns:
+        (dict): list of results, each either the response or an error.
+    """
+    results = []
+    for request in body.get('requests', []):
+        if not isinstance(request, dict):
+            results.append({'error': "request must be an object"})
+            continue
+        handler = ENDPOINTS.get(request.get('path'))
+        if handler is None or handler is batch:
+            results.append({'error': f"unknown path '{request.get('path')}'"})
+            continue
+        if not isinstance(request.get('body', {}), dict):
+            results.append({'error': "request body must be an object"})
+            continue
+        try:
+            results.append(handler(request.get('body', {})))
+        except (RequestError, KeyError, TypeError, ValueError) as error:
+            results.append({'error': str(error)})
+    return {'results': results}
+
+ENDPOINTS = {'/questions': questions,
+             '/variables': variables,
+             '/filter': count_demographic,
+             '/distribution': distribution,
+             '/compare': compare,
+             '/batch': batch}
+
+JSON_PARAMETERS = ['demographic', 'demographics', 'remove', 'requests']
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Answers GET and POST requests to the endpoints with JSON.
+
+    GET requests pass their parameters in the query string, with keywords
+    separated by commas and the parameters in 'JSON_PARAMETERS' as JSON. POST
+    requests pass them as a JSON object. The endpoints are run on the worker
+    pool of the server.
+    """
+    protocol_version = 'HTTP/1.1'  # Keep connections alive between requests
+    timeout = 30  # Seconds an idle connection is kept open
+    disable_nagle_algorithm = True  # Headers and body are written separately
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        body = {}
+        for k, v in parse_qs(url.query).items():
+            if k == 'keywords':
+                body[k] = v[0].split(',')
+            elif k in JSON_PARAMETERS:
+                try:
+                    body[k] = json.loads(v[0])
+                except ValueError:
+                    self.send_json(400, {'error': f"invalid JSON in '{k}'"})
+                    return
+            else:
+                body[k] = v[0]
+        self.respond(url.path, body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.send_json(400, {'error': 'invalid JSON'})
+            return
+        self.respond(urlparse(self.path).path, body)
+
+    def respond(self, path, body):
+        handler = ENDPOINTS.get(path)
+        if handler is None:
+            self.send_json(404, {'error': f"unknown path '{path}'"})
+            return
+        if not isinstance(body, dict):
+            self.send_json(400, {'error': 'request must be an object'})
+            return
+        try:
+            response = self.server.pool.submit(handler, body).result()
+        except (RequestError, KeyError, TypeError, ValueError) as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        except Exception as error:
+            self.send_json(500, {'error': f"internal error: {error}"})
+            return
+        self.send_json(200, response)
+
+    def send_json(self, status, response):
+        data = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # Logging every request would dominate the latency
+
+class PooledHTTPServer(ThreadingHTTPServer):
+    """HTTP server answering requests on a fixed pool of worker threads.
+
+    Each connection is read on a thread of its own, so connections kept alive
+    between requests do not hold a worker while idle.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, handler, workers):
+        super().__init__(address, handler)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+def main(args):
+    """Processes to be executed when 'ok_server.py' is called."""
+    global _state
+    _state = load_state(args.snapshot)
+    server = PooledHTTPServer((args.host, args.port), RequestHandler,
+                              args.workers)
+    print(f'Serving on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    description = """This script serves the operations of "okapp.py" as a local \
+HTTP/JSON API, for use by other tools.
+
+The cleaned dataset is loaded once. Requests are answered by a pool of worker \
+threads. Connections may be kept alive, and are closed after 30 s idle.
+
+Endpoints (GET with a query string, or POST with a JSON object). In a query \
+string, 'keywords' are separated by commas and 'demographic', 'demographics', \
+'remove' and 'requests' are JSON:
+/questions     search the questions by 'keywords' and 'text'
+/variables     list the categorical variables and traits
+/filter        count a 'demographic' that answered a 'question'
+/distribution  distribution of a 'demographic''s answers to a 'question'
+/compare       compare the 'demographics' and population on a 'question'
+/batch         answer a list of 'requests', each with a 'path' and 'body'
+
+Must be run in the same directory as the outputs of "clean_dataset.py" and \
+"question_data.csv". With "--snapshot NAME", the outputs in "snapshots/NAME" \
+are served instead.
+
+Author: Harry Durnberger
+"""
+    parser = argparse.ArgumentParser(description=description,
+                                     formatter_class=
+                                     argparse.RawTextHelpFormatter)
+    parser.add_argument('--snapshot', default='',
+                        help="name of the snapshot of the cleaned dataset to "
+                        "serve")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="address to listen on")
+    parser.add_argument('--port', type=int, default=8765,
+                        help="port to listen on")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="number of worker threads")
+    args = parser.parse_args()
+    main(args)
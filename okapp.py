@@ -3,7 +3,9 @@
 # This local app is run in the browser.  It is used to provide an easy-to-use
 # GUI to help the user filter the demographic of the OKCupid dataset, and 
 # observe this demographic's probabilities of giving particular answers to a 
-# selected question, in comparison to the full population.
+# selected question, in comparison to the full population. Any number of
+# snapshots of the dataset written by "clean_dataset.py" may be switched
+# between, and the demographic compared across them.
 #
 # The filtered demographic may be written to "okcupid_demographic.pkl".
 #
@@ -13,80 +15,112 @@ import pandas as pd
 import plotly.express as px
 import streamlit as st
 import numpy as np
-import pickle
-
-@st.cache_resource  # Cache outputs
-def load_dataset():
-    """Loads the dataset and list of features.
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import partial
+import ok_engine
+
+MEMORY_BUDGET_MB = int(os.environ.get('OKAPP_MEMORY_BUDGET_MB', 8192))
+
+@st.cache_resource  # Shared by all sessions
+def load_snapshot_cache():
+    """Creates the cache of loaded dataset snapshots.
+    
+    The snapshots held, with their indexes, are kept within a memory budget
+    of 'MEMORY_BUDGET_MB', set by the 'OKAPP_MEMORY_BUDGET_MB' environment
+    variable, by evicting the least recently used.
 
     Returns:
-        ok (pandas.DataFrame): cleaned OkCupid dataset.
-        features (list): list of all features.
+        cache (dict): cache of loaded snapshots.
     """
-    ok = pd.read_pickle("ok.pkl")
-    with open('features.txt', 'r') as f:
-        lines = f.readlines()
-        features = []
-        for l in lines:
-            features.append(l.replace("\n",""))
-    return ok, features
+    return ok_engine.snapshot_cache(MEMORY_BUDGET_MB*2**20)
 
-@st.cache_resource
-def load_qs_and_traits(features):
-    """Loads questions and traits information.
-    
-    Divides information into separate dataframes. The questions information is
-    the question, options and keywords associated with each question index. The
-    traits information is the name of each trait associated with each trait
-    index.
+def snapshot_label(name):
+    """Labels a dataset snapshot in the sidebar.
 
     Args:
-        features (list): list of all features.
+        name (str): name of the snapshot.
 
     Returns:
-        qs_and_traits (pandas.DataFrame): dataframe containing information
-        associated with all questions and traits.
-        qs (pandas.DataFrame): dataframe containing information associated with
-        all questions.
-        total_questions (int): original total number of questions.
-        traits (pandas.DataFrame): dataframe containing information associated
-        with all traits.
+        (str): label of the snapshot.
     """
-    qs_and_traits = pd.read_csv("question_data.csv", sep=';')
-    qs = qs_and_traits[:-79]  # Keep only questions
-    qs.Keywords = qs.Keywords.fillna('Other')
-    total_questions = len(qs)
-    traits = qs_and_traits[qs_and_traits.iloc[:, 0].isin(features)]
-    return qs_and_traits, qs, total_questions, traits
+    return name if name != '' else 'Working directory'
 
-@st.cache_resource
-def load_new_features():
-    """Loads list of new features created in 'clean_dataset.py'.
+def select_snapshot():
+    """Sets up the dataset snapshot selection tools in the sidebar.
+    
+    Stops the app if no snapshot has been written by 'clean_dataset.py'. The
+    other snapshots may only be compared with if there are any.
 
     Returns:
-        new_features (list): list of lists of newly created features sorted
-        by group.
+        name (str): name of the chosen snapshot.
+        compared (list): names of the snapshots to compare the chosen
+        snapshot with.
     """
-    with open("new_features.txt", "rb") as f:
-        new_features = pickle.load(f)
-    return new_features
+    names = ok_engine.list_snapshots()
+    if len(names) == 0:
+        st.error("No cleaned dataset found. Please run 'clean_dataset.py'.")
+        st.stop()
+    name = st.sidebar.selectbox("Dataset:", options=names,
+                                format_func=snapshot_label)
+    compared = []
+    if len(names) > 1:
+        compared = st.sidebar.multiselect("Compare with datasets:",
+                                          options=[n for n in names
+                                                   if n != name],
+                                          format_func=snapshot_label,
+                                          default=None)
+    return name, compared
+
+def load_snapshot(name):
+    """Loads a dataset snapshot, or gets it from the cache.
 
-@st.cache_resource
-def create_traits_dictionary(traits):
-    """Creates dictionary for traits and other continuous variables.
+    Args:
+        name (str): name of the snapshot.
+
+    Returns:
+        snapshot (dict): the cleaned dataset and associated information, as
+        loaded by 'ok_engine.load_snapshot'.
+    """
+    with st.spinner(f"Loading '{snapshot_label(name)}'..."):
+        return ok_engine.get_snapshot(load_snapshot_cache(), name)
+
+def check_layout(snapshot):
+    """Stops the app if the cleaned outputs do not match their manifest.
+
+    Args:
+        snapshot (dict): dataset snapshot.
+    """
+    errors = snapshot['errors']
+    if len(errors) > 0:
+        st.error("The cleaned dataset does not match the layout expected by "
+                 "the app. Please rerun 'clean_dataset.py'.\n\n"
+                 + "\n".join(f"- {error}" for error in errors))
+        st.stop()
+
+@st.cache_data(max_entries=64)
+def demographic_trait_profile(content_hash, packed_mask, trait_names, _block,
+                              _population):
+    """Computes the trait profile of a demographic.
     
-    The labels are the names of each trait or continuous variable. The values
-    are the indexes associated with each label.
+    Cached against the packed demographic mask, so that revisiting a
+    demographic does not recompute its profile.
 
     Args:
-        traits (pandas.DataFrame): dataframe containing information associated
-        with all traits.
+        content_hash (str): content hash of the cleaned dataset.
+        packed_mask (numpy.ndarray): demographic row mask packed into bits.
+        trait_names (tuple): names of the traits, in column order.
+        _block (numpy.ndarray): float32 trait block (not hashed).
+        _population (numpy.ndarray): summary of the population (not hashed).
 
     Returns:
-        traits (dict): traits dictionary.
+        profile (pandas.DataFrame): trait profile of the demographic.
     """
-    traits = traits.set_index('text').to_dict()['Unnamed: 0']
-    return traits
+    mask = np.unpackbits(packed_mask, count=len(_block)).astype(bool)
+    return ok_engine.trait_profile(_block, mask, _population,
+                                   list(trait_names))
 
 def filter_by_keywords(qs):
     """Sets up the keyword multi-selection tool in the sidebar.
@@ -102,14 +136,9 @@ def filter_by_keywords(qs):
         filtered questions.
     """
     st.sidebar.subheader("Please filter and select a question:")
-    list_keywords = ['descriptive', 'preference', 'opinion', 'sex', 'intimacy',
-                    'politics','religion', 'superstition', 'cognitive',
-                    'technology', 'BDSM']
     keywords = st.sidebar.multiselect("Select keywords:",
-                                    options=list_keywords, default=None)
-    for keyword in keywords:
-        qs = qs[qs['Keywords'].str.contains(keyword)]
-    return qs
+                                    options=ok_engine.KEYWORDS, default=None)
+    return ok_engine.filter_questions(qs, keywords)
 
 def initialise_question_selection(qs):
     """Sets up the question number selection tool in the sidebar.
@@ -238,10 +267,30 @@ def filter_chosen_question(ok, chosen_q_int, qs_and_traits, features, indexes):
     indexes_of_qs_and_traits = qs_and_traits['Unnamed: 0']
     q_number = (indexes_of_qs_and_traits[[q_index]]).iloc[0]
     columns = features + [q_number]
-    ok1 = ok.copy()
-    ok1 = ok1[columns].dropna(subset=[q_number])
+    ok1 = ok[columns].dropna(subset=[q_number])  # Selecting columns copies
     return ok1, q_number
 
+def display_related_questions(related, q_number, qs_and_traits):
+    """Displays the questions whose answers are most associated with the chosen
+    question's.
+
+    Provides a checkbox that may be used to display the related questions,
+    looked up in the precomputed related questions index.
+
+    Args:
+        related (dict): related questions index.
+        q_number (str): ID of chosen question.
+        qs_and_traits (pandas.DataFrame): dataframe containing information 
+        associated with all questions and traits.
+    """
+    if q_number not in related:
+        return
+    if st.checkbox('Display related questions', value=False):
+        texts = qs_and_traits.set_index('Unnamed: 0')['text']
+        for other, v, n in related[q_number]:
+            st.text(f"{other} (Cramér's V: {v:.2f}, answered by both: {n}): "
+                    f"{texts[other]}")
+
 def remove_options(ok1, q_number, options):
     """Creates tool allowing the user to select options they wish to remove.
     
@@ -256,12 +305,13 @@ def remove_options(ok1, q_number, options):
 
     Returns:
         ok1 (pandas.DataFrame): filtered OkCupid dataset.
+        options_remove (list): list of options removed.
     """
     options_remove = st.sidebar.multiselect("Select categories to remove:",
                                             options=options, default=None)
     for option in options_remove:
         ok1 = ok1[ok1[q_number] != option]
-    return ok1
+    return ok1, options_remove
 
 def categorical_selectboxes(new_features):
     """Creates selectboxes allowing selection of categorical variables.
@@ -306,54 +356,66 @@ def categorical_checkboxes():
     no_kids = st.sidebar.checkbox("Don't have kids", value=False)
     return have_kids, no_kids
 
-def filter_categoricals(ok1, chosen_all):
-    """Filters OkCupid dataset by selected categorical variables.
+def question_conditions(qs):
+    """Creates tools for conditioning the demographic on answers to questions.
+    
+    Sets up a multi-selection tool in the sidebar allowing the user to choose
+    any number of questions, and a selectbox for each chosen question allowing
+    the user to choose the answer individuals must have given to it.
 
     Args:
-        ok1 (pandas.DataFrame): OkCupid dataset.
-        chosen_all (list): list of all chosen categoricals.
+        qs (pandas.DataFrame): dataframe containing information associated with
+        all questions.
 
     Returns:
-        ok1 (pandas.DataFrame): filtered OkCupid dataset.
+        conditions (list): list of (question ID, answer) tuples.
     """
-    ok_list = []
-    for category in chosen_all:
-        ok2 = ok1.copy()
-        ok_list.append(ok2[ok2[category] == 1])
-    ok1 = pd.concat(ok_list).drop_duplicates().reset_index(drop=True)
-    for category in chosen_all:
-        ok1 = ok1[ok1[category] == 1]
-    return ok1
+    labels = [f"{q_id}: {text}" for q_id, text in zip(qs['Unnamed: 0'],
+                                                       qs['text'])]
+    chosen_labels = st.sidebar.multiselect("Answered questions:",
+                                           options=labels, default=None)
+    rows = qs.set_index(pd.Index(labels))
+    conditions = []
+    for label in chosen_labels:
+        row = rows.loc[label]
+        options = [''] + [row[f'option_{i}'] for i in range(1, 5)
+                          if pd.isna(row[f'option_{i}']) == False]
+        answer = st.sidebar.selectbox(f"Answer to {row['Unnamed: 0']}:",
+                                      options=options, key=f"{label}.answer")
+        if answer != '':
+            conditions.append((row['Unnamed: 0'], answer))
+    return conditions
+
+def load_condition_indexes(snapshot, conditions):
+    """Loads the answer-code indexes of the questions used as conditions.
 
-def categorical_selection(ok1, new_features):
+    Args:
+        snapshot (dict): dataset snapshot, holding the indexes built so far.
+        conditions (list): list of (question ID, answer) tuples.
+
+    Returns:
+        answer_indexes (dict): answer-code index of each conditioned question,
+        keyed by question ID.
+    """
+    return {q_number: ok_engine.snapshot_answer_index(snapshot, q_number)
+            for q_number, _ in conditions}
+
+def categorical_selection(new_features):
     """Creates categorical selectboxes and checkboxes in the sidebar.
-    
-    Filters the OkCupid dataset according to the user's selections.
 
     Args:
-        ok1 (pandas.DataFrame): OkCupid dataset.
         new_features (list): list of lists of newly created features sorted
         by group.
 
     Returns:
-        ok1 (pandas.DataFrame): filtered OkCupid dataset.
-        made_selection (bool): True if the user has made a selection, False
+        chosen_all (list): list of all selected categorical variables.
+        have_kids (bool): True if the user checks 'Have kids', False otherwise.
+        no_kids (bool): True if the user checks 'Don't have kids', False
         otherwise.
     """
-    st.sidebar.subheader("Please filter the demographic:")
     chosen_all = categorical_selectboxes(new_features)
-    made_selection = False
-    if len(chosen_all) > 0:
-        made_selection = True
-        ok1 = filter_categoricals(ok1, chosen_all)
     have_kids, no_kids = categorical_checkboxes()
-    if have_kids:
-        made_selection = True
-        ok1 = ok1[ok1['Has kids'] == 1]
-    if no_kids:
-        made_selection = True
-        ok1 = ok1[ok1['Has kids'] == 0]
-    return ok1, made_selection
+    return chosen_all, have_kids, no_kids
 
 def continuous_multiselect(traits):
     """Creates tools for selecting traits and other continuous variables.
@@ -369,8 +431,8 @@ def continuous_multiselect(traits):
         variables.
     """
     keys = list(traits.keys())
-    keys_traits = sorted(keys[0:50])
-    keys_other = keys[50:53]
+    keys_traits = sorted(keys[0:ok_engine.NUM_TRAITS])
+    keys_other = keys[ok_engine.NUM_TRAITS:]
     chosen_traits = st.sidebar.multiselect("Traits:", 
                                            options=keys_traits, default=None)
     chosen_other = st.sidebar.multiselect("Other:", 
@@ -427,121 +489,313 @@ def percentile_range(chosen_traits, traits):
         st.markdown("""---""")
     return selected_range, chosen_trait_ids
 
-def filter_traits(ok1, selected_range, chosen_trait_ids):
-    """Filters the OkCupid dataset by selected continuous variables.
-    
-    Filters each trait by the corresponding selected percentile range. The
-    lower and upper percentile bounds of each continuous variable are scaled to
-    the range of values in 'ok1'.
-
-    Args:
-        ok1 (pandas.DataFrame): OkCupid dataset.
-        selected_range (numpy.ndarray): matrix of chosen percentile range
-        boundary values.
-        chosen_trait_ids (list): list of IDs corresponding to chosen traits.
-
-    Returns:
-        ok1 (pandas.DataFrame): filtered OkCupid dataset.
-    """
-    for i, trait in enumerate(chosen_trait_ids):
-        total_range = ok1[trait].max() - ok1[trait].min()
-        lowerbound = selected_range[i, 0]*0.01*total_range + ok1[trait].min()
-        upperbound = selected_range[i, 1]*0.01*total_range + ok1[trait].min()
-        ok1 = ok1[(ok1[trait] >= lowerbound) & (ok1[trait] <= upperbound)]
-    return ok1
-
-def continuous_selection(ok1, made_selection, traits):
+def continuous_selection(traits):
     """Creates tools to allow selection of continuous variables.
     
     Creates multi-select tools in the sidebar to allow selection of continuous
     variables. Provides percentile range sliders to allow the user to choose
-    the percentile range over which to filter the traits. Filters the OkCupid
-    dataset according to the user's selections.
+    the percentile range over which to filter the traits.
 
     Args:
-        ok1 (pandas.DataFrame): OkCupid dataset.
-        made_selection (bool): True if the user has previously made a
-        selection, False otherwise.
         traits (dict): traits dictionary.
 
     Returns:
-        ok1 (pandas.DataFrame): filtered OkCupid dataset.
-        made_selection (bool): True if the user has made a selection, False
-        otherwise.
+        selected_range (numpy.ndarray): matrix of chosen percentile range
+        boundary values.
+        chosen_trait_ids (list): list of IDs corresponding to chosen traits.
     """
     chosen_traits = continuous_multiselect(traits)
+    selected_range = np.zeros(shape=(0, 2))
+    chosen_trait_ids = []
     if len(chosen_traits) > 0:
-        made_selection = True
         st.subheader("Chosen traits:")
         selected_range, chosen_trait_ids = percentile_range(chosen_traits,
                                                             traits)
-        ok1 = filter_traits(ok1, selected_range, chosen_trait_ids)
-    return ok1, made_selection
+    return selected_range, chosen_trait_ids
 
-def selection(ok1, new_features, traits):
-    """Creates tools allowing the selection of variables. Filters the dataset.
+def selection(all_qs, new_features, traits):
+    """Creates tools allowing the selection of variables.
     
     Creates tools in the sidebar allowing the user to select variables they
-    wish to filter the OkCupid dataset with. Filters the OkCupid dataset
-    according to the user's selections.
+    wish to filter the OkCupid dataset with. The dataset is filtered according
+    to the user's selections by 'run_analysis', away from the script thread.
 
     Args:
-        ok1 (pandas.DataFrame): OkCupid dataset.
+        all_qs (pandas.DataFrame): dataframe containing information associated
+        with all questions.
         new_features (list): list of lists of newly created features sorted
         by group.
         traits (dict): traits dictionary.
 
     Returns:
-        ok1 (pandas.DataFrame): filtered OkCupid dataset.
+        demographic (dict): selections defining the demographic, as expected
+        by 'ok_engine.filter_demographic'.
         made_selection (bool): True if the user has made a selection, False
         otherwise.
     """
-    ok1, made_selection = categorical_selection(ok1, new_features)
-    ok1, made_selection = continuous_selection(ok1, made_selection, traits)
-    return ok1, made_selection
+    st.sidebar.subheader("Please filter the demographic:")
+    conditions = question_conditions(all_qs)
+    chosen_all, have_kids, no_kids = categorical_selection(new_features)
+    selected_range, chosen_trait_ids = continuous_selection(traits)
+    demographic = {'conditions': conditions,
+                   'categories': chosen_all,
+                   'have_kids': have_kids,
+                   'no_kids': no_kids,
+                   'selected_range': selected_range,
+                   'trait_ids': chosen_trait_ids}
+    made_selection = (len(conditions) > 0 or len(chosen_all) > 0 or have_kids
+                      or no_kids or len(chosen_trait_ids) > 0)
+    return demographic, made_selection
+
+@st.cache_resource
+def load_analysis_pool():
+    """Creates the pool of threads that analyses are run on.
 
-def plot_histogram(ok1, q_number, demographic):
-    """Plots a histogram for the population or the chosen demographic.
+    Threads are used rather than processes so that the dataset is shared
+    rather than copied. The pool is shared by all sessions.
+
+    Returns:
+        pool (concurrent.futures.ThreadPoolExecutor): analysis thread pool.
+    """
+    return ThreadPoolExecutor(max_workers=os.cpu_count())
+
+def histogram_figure(counts, q_number, demographic):
+    """Creates a histogram for the population or the chosen demographic.
     
-    Plots a histogram showing the counts of each option of the
-    chosen question for either the population or the chosen demographic.
+    Creates a histogram showing the counts of each option of the chosen
+    question for either the population or the chosen demographic.
 
     Args:
-        ok1 (pandas.DataFrame): OkCupid dataset.
+        counts (pandas.Series): number of individuals choosing each option.
         q_number (str): ID of chosen question.
         demographic (str): name of particular demographic.
+
+    Returns:
+        count (plotly.graph_objects.Figure): histogram.
     """
-    count = px.histogram(ok1, x=q_number, title=(f'{demographic} countplot:'),
-                         text_auto=True)
+    counts = counts.rename_axis(q_number).reset_index(name='count')
+    count = px.bar(counts, x=q_number, y='count',
+                   title=(f'{demographic} countplot:'), text_auto=True)
     count.update_xaxes(categoryorder='category ascending')
-    st.plotly_chart(count,theme="streamlit")
+    return count
+
+def analyse(stage, cancelled, counts, q_number, demographic):
+    """Publishes the counts, histogram and probabilities of a demographic.
+    
+    Each result is published as soon as it is ready, so that it may be
+    displayed while the next is computed. Stops early if the analysis has
+    been superseded.
+
+    Args:
+        stage (dict): futures of the 'counts', 'figure' and 'probabilities'
+        results.
+        cancelled (threading.Event): set when the analysis is superseded.
+        counts (pandas.Series): number of individuals choosing each option,
+        in descending order.
+        q_number (str): ID of chosen question.
+        demographic (str): name of particular demographic.
+    """
+    if cancelled.is_set():
+        return
+    stage['counts'].set_result(counts)
+    if cancelled.is_set():
+        return
+    stage['figure'].set_result(histogram_figure(counts, q_number,
+                                                demographic))
+    if cancelled.is_set():
+        return
+    stage['probabilities'].set_result(counts/np.sum(counts))
+
+def run_analysis(job, ok, ok1, q_number, removed, demographic,
+                 answer_indexes, marginals):
+    """Analyses the population and filters and analyses the demographic.
+    
+    Runs on the analysis thread pool. If the demographic can be answered from
+    the trait marginals, the dataset is not filtered: its rows are left to be
+    filtered by 'demographic_rows' if they are needed. Results that are never
+    computed, because the analysis was superseded or failed, are cancelled or
+    set to the error raised.
+
+    Args:
+        job (dict): cancellation event and result futures of the analysis.
+        ok (pandas.DataFrame): cleaned OkCupid dataset.
+        ok1 (pandas.DataFrame): OkCupid dataset before selection.
+        q_number (str): ID of chosen question.
+        removed (list): list of options removed from the chosen question.
+        demographic (dict): selections defining the demographic, or None if
+        the user has not made a selection.
+        answer_indexes (dict): answer-code index of each conditioned question.
+        marginals (dict): trait marginals, or None.
+    """
+    futures = [*job['population'].values(), *job['demographic'].values()]
+    cancelled = job['cancelled']
+    try:
+        analyse(job['population'], cancelled, ok1[q_number].value_counts(),
+                q_number, 'Population')
+        if demographic is not None and not cancelled.is_set():
+            counts = None
+            if marginals is not None:
+                counts = ok_engine.marginal_counts(marginals, q_number,
+                                                   removed, demographic)
+            if counts is not None:
+                futures.remove(job['demographic']['rows'])  # Left to filter
+                analyse(job['demographic'], cancelled, counts, q_number,
+                        'Chosen demographic')
+                return
+            ok1 = ok_engine.filter_demographic(ok, ok1, demographic,
+                                               answer_indexes)
+            job['demographic']['rows'].set_result(ok1)
+            analyse(job['demographic'], cancelled,
+                    ok1[q_number].value_counts(), q_number,
+                    'Chosen demographic')
+    except Exception as error:
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+    finally:
+        for future in futures:
+            future.cancel()  # Only affects results that were never computed
+
+def compare_snapshot(cache, name, q_number, removed, demographic):
+    """Counts the answers of the population and demographic of a snapshot.
+    
+    Runs on the analysis thread pool, loading the snapshot if it is not held.
+    The cache is resolved on the script thread and passed in, as streamlit's
+    caches are not meant to be called from other threads.
+
+    Args:
+        cache (dict): cache of loaded snapshots.
+        name (str): name of the snapshot.
+        q_number (str): ID of chosen question.
+        removed (list): list of options removed from the chosen question.
+        demographic (dict): selections defining the demographic, or None if
+        the user has not made a selection.
+
+    Returns:
+        population (pandas.Series): number of individuals in the population
+        choosing each option, or None if the snapshot does not have the
+        chosen question.
+        counts (pandas.Series): the same for the demographic, or None.
+    """
+    snapshot = ok_engine.get_snapshot(cache, name)
+    if len(snapshot['errors']) > 0:
+        raise ValueError("it does not match its manifest, please rerun "
+                         "'clean_dataset.py'")
+    return ok_engine.snapshot_counts(snapshot, q_number, removed, demographic)
+
+def submit_analysis(ok, ok1, q_number, removed, demographic, answer_indexes,
+                    marginals, compared):
+    """Starts the analysis on the thread pool, superseding any previous one.
     
-def display_probabilities(ok1, q_number, demographic):
+    The previous analysis of the session is dropped: it is removed from the
+    pool if it has not started, and otherwise stops at its next stage. The
+    compared snapshots are each analysed by a separate task.
+
+    Args:
+        ok (pandas.DataFrame): cleaned OkCupid dataset.
+        ok1 (pandas.DataFrame): OkCupid dataset before selection.
+        q_number (str): ID of chosen question.
+        removed (list): list of options removed from the chosen question.
+        demographic (dict): selections defining the demographic, or None if
+        the user has not made a selection.
+        answer_indexes (dict): answer-code index of each conditioned question.
+        marginals (dict): trait marginals, or None.
+        compared (list): names of the snapshots to compare with.
+
+    Returns:
+        job (dict): cancellation event and result futures of the analysis.
+    """
+    previous = st.session_state.get('analysis_job')
+    if previous is not None:
+        previous['cancelled'].set()
+        previous['task'].cancel()
+        previous['demographic']['rows'].cancel()
+        for future in previous['comparison'].values():
+            future.cancel()
+    job = {'cancelled': threading.Event(),
+           'population': {stage: Future() for stage in
+                          ['counts', 'figure', 'probabilities']},
+           'demographic': {stage: Future() for stage in
+                           ['rows', 'counts', 'figure', 'probabilities']}}
+    if demographic is not None:
+        job['filter'] = partial(ok_engine.filter_demographic, ok, ok1,
+                                demographic, answer_indexes)
+    pool = load_analysis_pool()
+    job['task'] = pool.submit(run_analysis, job, ok, ok1, q_number, removed,
+                              demographic, answer_indexes, marginals)
+    cache = load_snapshot_cache()
+    job['comparison'] = {name: pool.submit(compare_snapshot, cache, name,
+                                           q_number, removed, demographic)
+                         for name in compared}
+    st.session_state['analysis_job'] = job
+    return job
+
+def wait_for(future, status, message):
+    """Waits for a result of the analysis, displaying the time elapsed.
+    
+    The status is refreshed while waiting, which also lets Streamlit stop this
+    run of the script as soon as the user changes a widget.
+
+    Args:
+        future (concurrent.futures.Future): future of the result.
+        status (streamlit.delta_generator.DeltaGenerator): placeholder for the
+        status message.
+        message (str): status message.
+
+    Returns:
+        result: the result.
+    """
+    start = time.perf_counter()
+    while not future.done():
+        status.text(f"{message} ({time.perf_counter() - start:.1f}s)")
+        wait([future], timeout=0.1)
+    status.empty()
+    return future.result()
+
+def display_probabilities(probabilities, demographic):
     """Displays the probabilities of each option for a demographic.
     
     Displays the probabilities of an individual in either the population or the
     chosen demographic selecting any one of the options of the chosen question.
 
     Args:
-        ok1 (pandas.DataFrame): OkCupid dataset.
-        q_number (str): ID of chosen question.
+        probabilities (pandas.Series): probability of each option, in
+        descending order.
         demographic (str): name of particular demographic.
     """
-    counts = ok1[q_number].value_counts()  # Counts in descending order
     st.text("Probability of an individual choosing each option from "
             f"{demographic}:")
     st.text("")
-    last_option = len(counts) - 1
-    for i, count in enumerate(counts):
-        p = count/np.sum(counts)  # Probability of the option
+    last_option = len(probabilities) - 1
+    for i, p in enumerate(probabilities):
         if i == 0:
-            st.text(f"{counts.index[i]} : {int(100*p)}% (most likely)")
+            st.text(f"{probabilities.index[i]} : {int(100*p)}% (most likely)")
         elif i == last_option:
-            st.text(f"{counts.index[i]} : {int(100*p)}% (least likely)")
+            st.text(f"{probabilities.index[i]} : {int(100*p)}% (least likely)")
         else:
-            st.text(f"{counts.index[i]} : {int(100*p)}%")
+            st.text(f"{probabilities.index[i]} : {int(100*p)}%")
+
+def display_stages(stage, demographic):
+    """Displays the results of an analysis progressively.
+    
+    Displays the number of individuals, then the histogram, then the
+    probabilities, each as soon as it is ready.
 
-def population_analysis(ok1, q_number):
+    Args:
+        stage (dict): futures of the 'counts', 'figure' and 'probabilities'
+        results.
+        demographic (str): name of particular demographic.
+    """
+    status = st.empty()
+    counts = wait_for(stage['counts'], status, "Counting answers...")
+    st.text(f"Number of individuals: {int(np.sum(counts))}")
+    figure = wait_for(stage['figure'], status, "Plotting...")
+    st.plotly_chart(figure, theme="streamlit")
+    probabilities = wait_for(stage['probabilities'], status,
+                             "Computing probabilities...")
+    display_probabilities(probabilities, demographic)
+
+def population_analysis(job):
     """Plots a histogram and displays probabilities for the population.
     
     Perform analysis on the total population of the OkCupid dataset that
@@ -550,14 +804,12 @@ def population_analysis(ok1, q_number):
     options of the chosen question.
     
     Args:
-        ok1 (pandas.DataFrame): OkCupid dataset before selection.
-        q_number (str): ID of chosen question.
+        job (dict): cancellation event and result futures of the analysis.
     """
-    plot_histogram(ok1, q_number, 'Population')
-    display_probabilities(ok1, q_number, 'population')
+    display_stages(job['population'], 'population')
     st.markdown("""---""")
 
-def chosen_demographic_analysis(ok1, q_number):
+def chosen_demographic_analysis(job):
     """Plots a histogram and displays probabilities for the chosen demographic.
     
     Perform analysis on the chosen demographic of the OkCupid dataset that
@@ -567,21 +819,118 @@ def chosen_demographic_analysis(ok1, q_number):
     display the filtered dataframe to the user.
 
     Args:
-        ok1 (pandas.DataFrame): OkCupid dataset after selection.
-        q_number (str): ID of chosen question.
+        job (dict): cancellation event and result futures of the analysis.
+
+    Returns:
+        counts (pandas.Series): number of individuals in the demographic
+        choosing each option.
     """
-    if len(ok1[q_number]) == 0:
+    status = st.empty()
+    counts = wait_for(job['demographic']['counts'], status,
+                      "Filtering the demographic...")
+    if len(counts) == 0:
         st.text('No data for chosen demographic.')
     else:
         st.subheader('Chosen demographic analysis:')
-        plot_histogram(ok1, q_number, 'Chosen demographic')
-        display_probabilities(ok1, q_number, 'chosen demographic')
+        display_stages(job['demographic'], 'chosen demographic')
         st.markdown("##")
         df_check = st.checkbox('Display dataframe', value=False)
         if df_check:
-            st.dataframe(ok1)
+            st.dataframe(demographic_rows(job))
+    return counts
+
+def demographic_rows(job):
+    """Gets the dataset of the chosen demographic.
+    
+    If the analysis answered the demographic from the trait marginals, the
+    dataset is only filtered now, on the analysis thread pool, as it is
+    needed.
 
-def save_demographic(ok1):
+    Args:
+        job (dict): cancellation event and result futures of the analysis.
+
+    Returns:
+        ok1 (pandas.DataFrame): OkCupid dataset after selection.
+    """
+    status = st.empty()
+    wait_for(job['task'], status, "Filtering the demographic...")
+    if not job['demographic']['rows'].done():
+        job['demographic']['rows'] = load_analysis_pool().submit(job['filter'])
+    return wait_for(job['demographic']['rows'], status,
+                    "Filtering the demographic...")
+
+def display_trait_profile(snapshot, job):
+    """Displays how the chosen demographic's traits differ from the population.
+    
+    Provides a checkbox that may be used to display the mean, median and
+    effect size of every trait and other continuous variable for the chosen
+    demographic, sorted by the size of the effect.
+
+    Args:
+        snapshot (dict): dataset snapshot.
+        job (dict): cancellation event and result futures of the analysis.
+    """
+    if st.checkbox('Display trait profile', value=False):
+        ok = snapshot['ok']
+        ok1 = demographic_rows(job)
+        block, population = ok_engine.snapshot_trait_block(snapshot)
+        mask = ok_engine.rows_mask(ok.index, ok1.index)
+        profile = demographic_trait_profile(ok.attrs['content_hash'],
+                                            np.packbits(mask),
+                                            tuple(snapshot['traits'].keys()),
+                                            block, population)
+        order = profile['Effect size'].abs().sort_values(ascending=False)
+        st.dataframe(profile.loc[order.index])
+
+def comparison_analysis(job, name, q_number, made_selection):
+    """Compares the chosen demographic across dataset snapshots.
+    
+    Displays the number of individuals in the chosen demographic, or the
+    population if the user has not made a selection, in the chosen snapshot
+    and each compared snapshot, and their probabilities of selecting each
+    option of the chosen question, as a table and a grouped histogram.
+    Snapshots that cannot be compared are listed with the reason.
+
+    Args:
+        job (dict): cancellation event and result futures of the analysis.
+        name (str): name of the chosen snapshot.
+        q_number (str): ID of chosen question.
+        made_selection (bool): True if the user has made a selection, False
+        otherwise.
+    """
+    st.subheader('Comparison across datasets:')
+    status = st.empty()
+    stage = 'demographic' if made_selection else 'population'
+    counts = {snapshot_label(name): wait_for(job[stage]['counts'], status,
+                                             "Counting answers...")}
+    for other, future in job['comparison'].items():
+        try:
+            population, demographic = wait_for(future, status,
+                                               "Counting answers in "
+                                               f"'{snapshot_label(other)}'...")
+        except Exception as error:
+            st.text(f"'{snapshot_label(other)}' cannot be compared: {error}")
+            continue
+        if population is None:
+            st.text(f"'{snapshot_label(other)}' does not have the chosen "
+                    "question.")
+            continue
+        counts[snapshot_label(other)] = (demographic if made_selection
+                                         else population)
+    table = pd.DataFrame(counts).fillna(0)
+    for label, total in table.sum().items():
+        st.text(f"Number of individuals in '{label}': {int(total)}")
+    probabilities = (100*table/table.sum()).rename_axis(q_number)
+    st.dataframe(probabilities.round(1))
+    long = probabilities.reset_index().melt(id_vars=q_number,
+                                            var_name='dataset',
+                                            value_name='probability (%)')
+    figure = px.bar(long, x=q_number, y='probability (%)', color='dataset',
+                    barmode='group', title='Comparison across datasets:')
+    figure.update_xaxes(categoryorder='category ascending')
+    st.plotly_chart(figure, theme="streamlit")
+
+def save_demographic(job):
     """Creates a button for saving the filtered dataframe to a .pkl file.
     
     Provides a clickable button for the user to press if they desire to save
@@ -589,25 +938,35 @@ def save_demographic(ok1):
     'okcupid_demographic.pkl'.
 
     Args:
-        ok1 (pandas.DataFrame): filtered OkCupid dataset.
+        job (dict): cancellation event and result futures of the analysis.
     """
     if st.button('Save dataframe'):
-        ok1.to_pickle('okcupid_demographic.pkl')
+        demographic_rows(job).to_pickle('okcupid_demographic.pkl')
     st.text("Click here to save dataframe of chosen demographic to \
 'okcupid_demographic.pkl'")
 
 def main():
     """Executes when the app is launched and whenever it is refreshed.
     
-    Note that the outputs of the functions used to load the data and create the
-    traits dictionary are cached. These functions run once when the app is
-    launched and are ignored when it is later refreshed.
+    Note that the dataset snapshots are cached, along with the indexes built
+    from them. A snapshot is loaded when it is first chosen, and checked
+    against the manifest written by 'clean_dataset.py' before use.
+    
+    All widgets are created before any analysis is displayed. The analysis
+    itself runs on a thread pool and its results are displayed as they
+    arrive, so that a change to a widget supersedes it straight away.
     """
-    ok, features = load_dataset()
-    qs_and_traits, qs, total_questions, traits = load_qs_and_traits(features)
-    new_features = load_new_features()
-    traits = create_traits_dictionary(traits)
-    qs = filter_by_keywords(qs)
+    name, compared = select_snapshot()
+    snapshot = load_snapshot(name)
+    check_layout(snapshot)
+    ok = snapshot['ok']
+    features = snapshot['features']
+    qs_and_traits = snapshot['qs_and_traits']
+    total_questions = snapshot['total_questions']
+    traits = snapshot['traits']
+    new_features = snapshot['new_features']
+    all_qs = snapshot['qs']
+    qs = filter_by_keywords(all_qs)
     (chosen_q_num, qs, indexes,
      num_questions) = initialise_question_selection(qs)
     if chosen_q_num == '':
@@ -619,15 +978,28 @@ def main():
                                                qs_and_traits,
                                                features,
                                                indexes)
-        ok1 = remove_options(ok1, q_number, options)
-        population_analysis(ok1, q_number)
-        ok1, made_selection = selection(ok1, new_features, traits)
+        display_related_questions(snapshot['related'], q_number,
+                                  qs_and_traits)
+        ok1, removed = remove_options(ok1, q_number, options)
+        population_area = st.container()
+        demographic, made_selection = selection(all_qs, new_features, traits)
+        answer_indexes = load_condition_indexes(snapshot,
+                                                demographic['conditions'])
+        job = submit_analysis(ok, ok1, q_number, removed,
+                              demographic if made_selection else None,
+                              answer_indexes, snapshot['marginals'], compared)
+        with population_area:
+            population_analysis(job)
         if made_selection:
-            chosen_demographic_analysis(ok1, q_number)
-            save_demographic(ok1)
+            counts = chosen_demographic_analysis(job)
+            if len(counts) > 0:
+                display_trait_profile(snapshot, job)
+            save_demographic(job)
         else:
             st.text('Please filter the demographic.')
-
+        if len(compared) > 0:
+            st.markdown("""---""")
+            comparison_analysis(job, name, q_number, made_selection)
 
 st.set_page_config(page_title="OkCupid Demographic Analysis",
                    page_icon=":mag:", layout="wide")
@@ -0,0 +1,218 @@
+import numpy as np
+import pandas as pd
+import pickle
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
+import ok_engine
+
+_matrix = None  # Worker state, set by 'init_worker'
+_width = None
+_min_respondents = None
+_top_k = None
+
+def load_cleaned_dataset(directory):
+    """Loads the cleaned OkCupid dataset written by 'clean_dataset.py'.
+
+    Args:
+        directory (str): directory of the outputs of 'clean_dataset.py'.
+
+    Returns:
+        ok (pandas.DataFrame): cleaned OkCupid dataset.
+    """
+    ok = pd.read_pickle(os.path.join(directory, "ok.pkl"))
+    return ok
+
+def build_answer_matrix(ok):
+    """Builds a sparse one-hot matrix of the answers to every question.
+
+    Each question is allotted 'width' consecutive columns, one per answer, so
+    the columns of question j are j*width to (j+1)*width - 1. Unanswered
+    questions contribute no entries, which keeps the matrix sparse.
+
+    Args:
+        ok (pandas.DataFrame): cleaned OkCupid dataset.
+
+    Returns:
+        matrix (scipy.sparse.csc_matrix): one-hot answer matrix with a row for
+        each individual.
+        q_ids (list): list of question IDs in column order.
+        width (int): number of columns allotted to each question.
+    """
+    q_ids = [c for c in ok.columns if ok_engine.is_question(c)]
+    answer_indexes = [ok_engine.build_answer_index(ok[q]) for q in q_ids]
+    width = max(len(answers) for _, answers in answer_indexes)
+    rows = []
+    cols = []
+    for j, (codes, _) in enumerate(answer_indexes):
+        answered = np.flatnonzero(codes >= 0)
+        rows.append(answered)
+        cols.append(j*width + codes[answered].astype(np.int64))
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    data = np.ones(len(rows), dtype=np.float32)
+    matrix = sparse.csc_matrix((data, (rows, cols)),
+                               shape=(len(ok), len(q_ids)*width))
+    return matrix, q_ids, width
+
+def cramers_v(tables, min_respondents):
+    """Computes Cramér's V for a stack of contingency tables.
+
+    Args:
+        tables (numpy.ndarray): contingency tables, with the answers of the
+        two questions along the last two axes.
+        min_respondents (int): minimum number of individuals that must have
+        answered both questions for V to be computed.
+
+    Returns:
+        v (numpy.ndarray): Cramér's V of each table, NaN where there are too
+        few co-respondents or either question has a single answer.
+        n (numpy.ndarray): number of co-respondents of each table.
+    """
+    n = tables.sum(axis=(-2, -1))
+    row = tables.sum(axis=-1)
+    col = tables.sum(axis=-2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = row[..., :, None]*col[..., None, :]/n[..., None, None]
+        terms = np.where(expected > 0, (tables - expected)**2/expected, 0)
+        chi2 = terms.sum(axis=(-2, -1))
+        k = np.minimum((row > 0).sum(axis=-1), (col > 0).sum(axis=-1)) - 1
+        v = np.sqrt(chi2/(n*k))
+    v[(n < min_respondents) | (k < 1)] = np.nan
+    return v, n
+
+def init_worker(matrix, width, min_respondents, top_k):
+    """Stores the shared inputs of 'association_block' in a worker process.
+
+    Args:
+        matrix (scipy.sparse.csc_matrix): one-hot answer matrix.
+        width (int): number of columns allotted to each question.
+        min_respondents (int): minimum number of co-respondents of a pair.
+        top_k (int): number of neighbours to keep for each question.
+    """
+    global _matrix, _width, _min_respondents, _top_k
+    _matrix = matrix
+    _width = width
+    _min_respondents = min_respondents
+    _top_k = top_k
+
+def association_block(block):
+    """Finds the most associated questions of a block of questions.
+
+    The contingency tables of every question in the block against every
+    question are obtained at once as a single sparse matrix product.
+
+    Args:
+        block (tuple): first and one-past-last question positions of the
+        block.
+
+    Returns:
+        neighbours (list): for each question in the block, a list of
+        (question position, V, co-respondents) tuples sorted by descending V.
+    """
+    start, stop = block
+    w = _width
+    num_qs = _matrix.shape[1]//w
+    block_matrix = _matrix[:, start*w:stop*w]
+    tables = (block_matrix.T @ _matrix).toarray()
+    tables = tables.reshape(stop - start, w, num_qs, w).transpose(0, 2, 1, 3)
+    v, n = cramers_v(tables, _min_respondents)
+    v[np.arange(stop - start), np.arange(start, stop)] = np.nan  # Not self
+    neighbours = []
+    for b in range(stop - start):
+        candidates = np.flatnonzero(~np.isnan(v[b]))
+        order = candidates[np.argsort(-v[b, candidates])][:_top_k]
+        neighbours.append([(int(j), float(v[b, j]), int(n[b, j]))
+                           for j in order])
+    return neighbours
+
+def compute_associations(matrix, q_ids, width, min_respondents, top_k,
+                         block_size, workers):
+    """Computes the top-k most associated questions of every question.
+
+    Args:
+        matrix (scipy.sparse.csc_matrix): one-hot answer matrix.
+        q_ids (list): list of question IDs in column order.
+        width (int): number of columns allotted to each question.
+        min_respondents (int): minimum number of co-respondents of a pair.
+        top_k (int): number of neighbours to keep for each question.
+        block_size (int): number of questions handled by each task.
+        workers (int): number of worker processes.
+
+    Returns:
+        related (dict): list of (question ID, V, co-respondents) tuples for
+        each question ID, sorted by descending V.
+    """
+    blocks = [(start, min(start + block_size, len(q_ids)))
+              for start in range(0, len(q_ids), block_size)]
+    related = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(matrix, width, min_respondents,
+                                       top_k)) as executor:
+        for (start, _), neighbours in zip(blocks,
+                                          executor.map(association_block,
+                                                       blocks)):
+            for b, block_neighbours in enumerate(neighbours):
+                related[q_ids[start + b]] = [(q_ids[j], v, n)
+                                             for j, v, n in block_neighbours]
+    return related
+
+def save_related_questions(related, content_hash, directory):
+    """Writes the related questions index to a .pkl file.
+
+    The index is stored with the content hash of the dataset it was computed
+    from, so that 'okapp.py' only uses it with that dataset.
+
+    Args:
+        related (dict): list of (question ID, V, co-respondents) tuples for
+        each question ID.
+        content_hash (str): content hash of the cleaned dataset.
+        directory (str): directory of the outputs of 'clean_dataset.py'.
+    """
+    with open(os.path.join(directory, 'related_questions.pkl'), "wb") as f:
+        pickle.dump({'content_hash': content_hash, 'related': related}, f)
+
+def main(args):
+    """Processes to be executed when 'question_associations.py' is called."""
+    directory = ok_engine.snapshot_directory(args.snapshot)
+    ok = load_cleaned_dataset(directory)
+    content_hash = ok.attrs.get('content_hash')
+    matrix, q_ids, width = build_answer_matrix(ok)
+    del ok
+    related = compute_associations(matrix, q_ids, width, args.min_respondents,
+                                   args.top_k, args.block_size, args.workers)
+    save_related_questions(related, content_hash, directory)
+    print('Question associations computed')
+
+
+if __name__ == "__main__":
+    description = """This script computes the association (Cramér's V) between \
+the answers to every pair of questions of the cleaned OkCupid dataset, and \
+keeps the most associated questions of each question.
+
+Pairs of questions are handled in blocks spread across processes. Pairs \
+answered by too few of the same individuals are skipped.
+
+Must be run after "clean_dataset.py", in the same directory as "ok.pkl".
+Related questions index is written to "related_questions.pkl".
+With "--snapshot NAME", both are in "snapshots/NAME" instead.
+
+Author: Harry Durnberger
+"""
+    parser = argparse.ArgumentParser(description=description,
+                                     formatter_class=
+                                     argparse.RawTextHelpFormatter)
+    parser.add_argument('--snapshot', default='',
+                        help="name of the snapshot of the cleaned dataset")
+    parser.add_argument('--top-k', type=int, default=10,
+                        help="number of related questions kept per question")
+    parser.add_argument('--min-respondents', type=int, default=100,
+                        help="minimum number of individuals that answered "
+                        "both questions of a pair")
+    parser.add_argument('--block-size', type=int, default=64,
+                        help="number of questions handled by each task")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="number of worker processes")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,255 @@
+import numpy as np
+import pickle
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import ok_engine
+
+_traits = None  # Worker state, set by 'init_worker'
+_categories = None
+_buckets = None
+_width = None
+DEFAULT_WORKERS = 4  # Each worker holds the traits and its own temporaries
+
+def load_cleaned_dataset(directory):
+    """Loads the cleaned dataset and list of new features.
+
+    Args:
+        directory (str): directory of the outputs of 'clean_dataset.py'.
+
+    Returns:
+        ok (pandas.DataFrame): cleaned OkCupid dataset.
+        features (list): list of all features.
+        new_features (list): list of lists of newly created features sorted
+        by group.
+    """
+    ok, features = ok_engine.read_dataset(directory)
+    new_features = ok_engine.read_new_features(directory)
+    return ok, features, new_features
+
+def trait_ids(features, directory):
+    """Finds the IDs of the traits and other continuous variables.
+
+    Args:
+        features (list): list of all features.
+        directory (str): directory of the outputs of 'clean_dataset.py'.
+
+    Returns:
+        (list): IDs of the traits and other continuous variables, as in the
+        traits dictionary of 'okapp.py'.
+    """
+    _, _, _, traits = ok_engine.read_qs_and_traits(features, directory)
+    return list(ok_engine.traits_dictionary(traits).values())
+
+def init_worker(traits, categories, buckets, width):
+    """Stores the shared inputs of 'question_marginals' in a worker process.
+
+    Args:
+        traits (numpy.ndarray): matrix of trait values with a row for each
+        individual and a column for each trait.
+        categories (numpy.ndarray): boolean matrix with a row for each
+        individual and a column for each category. The first column, for no
+        category, is all True.
+        buckets (int): number of percentile buckets.
+        width (int): maximum number of answers to a question.
+    """
+    global _traits, _categories, _buckets, _width
+    _traits = traits
+    _categories = categories
+    _buckets = buckets
+    _width = width
+
+def question_marginals(question, chunk=8):
+    """Counts the answers to a question in each trait percentile bucket.
+
+    For each category and trait, the individuals that answered the question,
+    belong to the category and have a value for the trait are bucketed by
+    percentile of the trait, scaled to the range of their values exactly as
+    'ok_engine.filter_traits' does. Bucket 0 holds values from the 0th to the
+    first boundary inclusive, and each following bucket holds values above
+    its lower boundary up to its upper boundary inclusive. Individuals lying
+    exactly on an inner boundary are also counted separately, as a range
+    starting at that boundary includes them.
+
+    Traits are handled a chunk at a time, so that memory use does not grow
+    with the number of traits.
+
+    Args:
+        question (tuple): positions of the individuals that answered the
+        question (numpy.ndarray) and their answer codes (numpy.ndarray).
+        chunk (int): number of traits handled at a time.
+
+    Returns:
+        counts (numpy.ndarray): answer counts of shape (categories, traits,
+        buckets, answers).
+        edge_counts (numpy.ndarray): answer counts of the individuals on each
+        inner boundary, of shape (categories, traits, buckets - 1, answers).
+    """
+    rows, codes = question
+    num_categories = _categories.shape[1]
+    num_traits = _traits.shape[1]
+    b = _buckets
+    cats, members = np.nonzero(_categories[rows].T)  # Sorted by category
+    individuals = rows[members]
+    answers = codes[members][:, None]
+    sizes = np.bincount(cats, minlength=num_categories)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    nonempty = sizes > 0
+    percentiles = np.arange(b + 1)*(100/b)
+    counts = np.zeros((num_categories, num_traits, b, _width), dtype=np.int64)
+    edge_counts = np.zeros((num_categories, num_traits, b - 1, _width),
+                           dtype=np.int64)
+    for first in range(0, num_traits, chunk):
+        width = min(chunk, num_traits - first)
+        values = _traits[individuals, first:first + width]  # (pairs, chunk)
+        present = ~np.isnan(values)
+        minimum = np.full((num_categories, width), np.nan)
+        maximum = np.full((num_categories, width), np.nan)
+        if len(cats) > 0:
+            minimum[nonempty] = np.minimum.reduceat(
+                np.where(present, values, np.inf), starts[nonempty])
+            maximum[nonempty] = np.maximum.reduceat(
+                np.where(present, values, -np.inf), starts[nonempty])
+        total_range = maximum - minimum
+        edges = ok_engine.percentile_bound(percentiles[None, None, :],
+                                           minimum[:, :, None],
+                                           total_range[:, :, None])
+        pair_cats = cats[:, None]
+        traits = np.arange(width)[None, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            guess = (values - minimum[cats])/total_range[cats]*b
+        bucket = np.clip(np.nan_to_num(np.floor(guess)), 0,
+                         b - 1).astype(np.intp)
+        # Correct the guess against the exact boundaries, at most one out
+        bucket += values > edges[pair_cats, traits, bucket + 1]
+        bucket -= (values <= edges[pair_cats, traits, bucket]) & (bucket > 0)
+        included = present & (bucket < b)  # Beyond the 100th boundary if not
+        bucket = np.minimum(bucket, b - 1)
+        upper_edge = edges[pair_cats, traits, bucket + 1]
+        on_edge = included & (values == upper_edge) & (bucket + 1 < b)
+        cells = pair_cats*width + traits
+        bins = ((cells*b + bucket)*_width + answers)[included]
+        counts[:, first:first + width] = np.bincount(
+            bins, minlength=num_categories*width*b*_width).reshape(
+                num_categories, width, b, _width)
+        bins = ((cells*(b - 1) + bucket)*_width + answers)[on_edge]
+        edge_counts[:, first:first + width] = np.bincount(
+            bins, minlength=num_categories*width*(b - 1)*_width).reshape(
+                num_categories, width, b - 1, _width)
+    return counts, edge_counts
+
+def compute_marginals(ok, features, new_features, buckets, workers,
+                      directory):
+    """Computes the trait marginals of every question.
+
+    Questions are spread across processes. The counts, and the counts on the
+    inner boundaries, are written to .npy files as they arrive, so they are
+    never all held in memory.
+
+    Args:
+        ok (pandas.DataFrame): cleaned OkCupid dataset.
+        features (list): list of all features.
+        new_features (list): list of lists of newly created features sorted
+        by group.
+        buckets (int): number of percentile buckets.
+        workers (int): number of worker processes.
+        directory (str): directory of the outputs of 'clean_dataset.py', to
+        write the .npy files of counts to.
+
+    Returns:
+        marginals (dict): everything but the counts needed to look up the
+        marginals: positions of each question, category and trait, and
+        answers to each question.
+    """
+    q_ids = [c for c in ok.columns if ok_engine.is_question(c)]
+    categories = [''] + [c for group in new_features for c in group if c != '']
+    t_ids = trait_ids(features, directory)
+    traits = ok[t_ids].to_numpy()
+    membership = np.column_stack([np.ones(len(ok), dtype=bool)]
+                                 + [(ok[c] == 1).to_numpy()
+                                    for c in categories[1:]])
+    answer_indexes = [ok_engine.build_answer_index(ok[q]) for q in q_ids]
+    width = max(len(answers) for _, answers in answer_indexes)
+    dtype = np.uint16 if len(ok) <= np.iinfo(np.uint16).max else np.uint32
+    shape = (len(q_ids), len(categories), len(t_ids))
+    counts = np.lib.format.open_memmap(
+        os.path.join(directory, 'trait_marginals.npy'), mode='w+',
+        dtype=dtype, shape=shape + (buckets, width))
+    edge_counts = np.lib.format.open_memmap(
+        os.path.join(directory, 'trait_marginals_edges.npy'), mode='w+',
+        dtype=dtype, shape=shape + (buckets - 1, width))
+    questions = ((np.flatnonzero(codes >= 0), codes[codes >= 0])
+                 for codes, _ in answer_indexes)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(traits, membership, buckets,
+                                       width)) as executor:
+        for q, (q_counts, q_edge_counts) in enumerate(
+                executor.map(question_marginals, questions, chunksize=8)):
+            counts[q] = q_counts
+            edge_counts[q] = q_edge_counts
+    counts.flush()
+    edge_counts.flush()
+    return {'buckets': buckets,
+            'question_positions': {q: i for i, q in enumerate(q_ids)},
+            'category_positions': {c: i for i, c in enumerate(categories)},
+            'trait_positions': {t: i for i, t in enumerate(t_ids)},
+            'answers': [answers for _, answers in answer_indexes]}
+
+def save_marginals(marginals, content_hash, directory):
+    """Writes the information needed to look up the marginals to a .pkl file.
+
+    Stored with the content hash of the dataset they were computed from, so
+    that 'okapp.py' only uses them with that dataset.
+
+    Args:
+        marginals (dict): marginals, without the counts.
+        content_hash (str): content hash of the cleaned dataset.
+        directory (str): directory of the outputs of 'clean_dataset.py'.
+    """
+    marginals['content_hash'] = content_hash
+    with open(os.path.join(directory, 'trait_marginals.pkl'), "wb") as f:
+        pickle.dump(marginals, f)
+
+def main(args):
+    """Processes to be executed when 'trait_marginals.py' is called."""
+    directory = ok_engine.snapshot_directory(args.snapshot)
+    ok, features, new_features = load_cleaned_dataset(directory)
+    marginals = compute_marginals(ok, features, new_features, args.buckets,
+                                  args.workers, directory)
+    save_marginals(marginals, ok.attrs.get('content_hash'), directory)
+    print('Trait marginals computed')
+
+
+if __name__ == "__main__":
+    description = """This script precomputes, for every question, the number \
+of individuals choosing each option within each percentile bucket (e.g. \
+decile) of each trait, for the population and for each categorical variable.
+
+Demographics defined by a single trait percentile range aligned with the \
+buckets, optionally combined with one categorical variable, are then answered \
+by "okapp.py" by summing these counts rather than filtering the dataset.
+
+Must be run after "clean_dataset.py", in the same directory as its outputs \
+and "question_data.csv".
+Counts are written to "trait_marginals.npy", and counts of the individuals on \
+the inner bucket boundaries to "trait_marginals_edges.npy".
+Information needed to look them up is written to "trait_marginals.pkl".
+With "--snapshot NAME", the outputs of "clean_dataset.py" are read from, and \
+these are written to, "snapshots/NAME" instead.
+
+Author: Harry Durnberger
+"""
+    parser = argparse.ArgumentParser(description=description,
+                                     formatter_class=
+                                     argparse.RawTextHelpFormatter)
+    parser.add_argument('--snapshot', default='',
+                        help="name of the snapshot of the cleaned dataset")
+    parser.add_argument('--buckets', type=int, default=10, choices=[10, 20],
+                        help="number of percentile buckets: 10 for deciles, "
+                        "20 for ventiles")
+    parser.add_argument('--workers', type=int,
+                        default=min(DEFAULT_WORKERS, os.cpu_count()),
+                        help="number of worker processes (default: "
+                        f"{DEFAULT_WORKERS}, or fewer CPUs)")
+    args = parser.parse_args()
+    main(args)